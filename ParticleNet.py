@@ -1,11 +1,18 @@
 import numpy as np
 import torch
 import torch.nn as nn
+from precision import noAutocast
 
 '''Based on https://github.com/WangYueFt/dgcnn/blob/master/pytorch/model.py.'''
 
 
 def knn(x, k):
+    # in float32 under any autocast: the 1e9 shift of the padded points overflows float16,
+    # and reduced precision reorders nearby neighbours
+    with noAutocast(x.device):
+        return knnFloat32(x.float(), k)
+
+def knnFloat32(x, k):
     inner = -2 * torch.matmul(x.transpose(2, 1), x)
     xx = torch.sum(x ** 2, dim=1, keepdim=True)
     pairwise_distance = -xx - inner - xx.transpose(2, 1)
@@ -13,6 +20,18 @@ def knn(x, k):
     return idx
 
 
+def get_mask(features):
+    # padded constituents have all their input features zero
+    return (features.abs().sum(dim=1, keepdim=True) != 0)  # (N, 1, P)
+
+
+def points_knn(points, mask, k):
+    # neighbours of the first EdgeConv block: they only depend on the coordinates of the constituents,
+    # so they can be computed once per jet (with padded constituents shifted away, as in ParticleNet.forward)
+    # and passed to forward as knn_idx
+    return knn(points * mask + (mask == 0) * 1e9, k)
+
+
 # v1 is faster on GPU
 def get_graph_feature_v1(x, k, idx):
     batch_size, num_dims, num_points = x.size()
@@ -29,6 +48,29 @@ def get_graph_feature_v1(x, k, idx):
     return fts
 
 
+# v2 never builds the (batch_size, 2*num_dims, num_points, k) edge features: it returns the output of the
+# first 1x1 conv on them, which is linear, W [x_i, x_j - x_i] = (W_c - W_d) x_i + W_d x_j. Both terms are
+# projected per point, only the neighbour term is gathered and the centre term is broadcast over the k neighbours
+def get_edge_conv_v2(conv, x, idx):
+    batch_size, num_dims, num_points = x.size()
+    k = idx.size(-1)
+    weight = conv.weight.view(conv.out_channels, 2 * num_dims)
+    w_centre, w_diff = weight[:, :num_dims], weight[:, num_dims:]
+    centre = torch.matmul(w_centre - w_diff, x)  # (batch_size, out_channels, num_points)
+    neighbours = torch.matmul(w_diff, x)  # (batch_size, out_channels, num_points)
+
+    idx_base = torch.arange(0, batch_size, device=x.device).view(-1, 1, 1) * num_points
+    idx = idx + idx_base
+    idx = idx.view(-1)
+
+    neighbours = neighbours.transpose(2, 1).reshape(-1, conv.out_channels)
+    neighbours = neighbours[idx, :].view(batch_size, num_points, k, conv.out_channels).permute(0, 3, 1, 2)
+    out = neighbours + centre.unsqueeze(-1)  # (batch_size, out_channels, num_points, k)
+    if conv.bias is not None:
+        out = out + conv.bias.view(1, -1, 1, 1)
+    return out
+
+
 class EdgeConvBlock(nn.Module):
     r"""EdgeConv layer.
     Introduced in "`Dynamic Graph CNN for Learning on Point Clouds
@@ -45,11 +87,15 @@ class EdgeConvBlock(nn.Module):
         Output feature size.
     batch_norm : bool
         Whether to include batch normalization on messages.
+    lean : bool
+        Whether to apply the first conv before gathering the neighbours (get_edge_conv_v2),
+        which is equivalent and uses less memory. The parameters are the same either way.
     """
 
-    def __init__(self, k, in_feat, out_feats, batch_norm=True, activation=True):
+    def __init__(self, k, in_feat, out_feats, batch_norm=True, activation=True, lean=False):
         super(EdgeConvBlock, self).__init__()
         self.k = k
+        self.lean = lean
         self.batch_norm = batch_norm
         self.activation = activation
         self.num_layers = len(out_feats)
@@ -78,13 +124,17 @@ class EdgeConvBlock(nn.Module):
         if activation:
             self.sc_act = nn.ReLU()
 
-    def forward(self, points, features):
+    def forward(self, points, features, knn_idx=None):
 
-        topk_indices = knn(points, self.k)
-        x = self.get_graph_feature(features, self.k, topk_indices)
+        topk_indices = knn(points, self.k) if knn_idx is None else knn_idx
+        if self.lean:
+            x = get_edge_conv_v2(self.convs[0], features, topk_indices)
+        else:
+            x = self.convs[0](self.get_graph_feature(features, self.k, topk_indices))
 
-        for conv, bn, act in zip(self.convs, self.bns, self.acts):
-            x = conv(x)  # (N, C', P, K)
+        for i, (conv, bn, act) in enumerate(zip(self.convs, self.bns, self.acts)):
+            if i > 0:
+                x = conv(x)  # (N, C', P, K)
             if bn:
                 x = bn(x)
             if act:
@@ -114,6 +164,7 @@ class ParticleNet(nn.Module):
                  use_counts=True,
                  for_inference=False,
                  for_segmentation=False,
+                 lean_edgeconv=False,
                  **kwargs):
         super(ParticleNet, self).__init__(**kwargs)
 
@@ -127,7 +178,7 @@ class ParticleNet(nn.Module):
         for idx, layer_param in enumerate(conv_params):
             k, channels = layer_param
             in_feat = input_dims if idx == 0 else conv_params[idx - 1][1][-1]
-            self.edge_convs.append(EdgeConvBlock(k=k, in_feat=in_feat, out_feats=channels))
+            self.edge_convs.append(EdgeConvBlock(k=k, in_feat=in_feat, out_feats=channels, lean=lean_edgeconv))
 
         self.use_fusion = use_fusion
         if self.use_fusion:
@@ -157,13 +208,13 @@ class ParticleNet(nn.Module):
 
         self.for_inference = for_inference
 
-    def forward(self, points, features, mask=None):
+    def forward(self, points, features, mask=None, knn_idx=None):
 #         print('points:\n', points)
 #         print('features:\n', features)
         if mask is None:
-            mask = (features.abs().sum(dim=1, keepdim=True) != 0)  # (N, 1, P)
-        points *= mask
-        features *= mask
+            mask = get_mask(features)
+        points = points * mask
+        features = features * mask
         coord_shift = (mask == 0) * 1e9
         if self.use_counts:
             counts = mask.float().sum(dim=-1)
@@ -176,7 +227,8 @@ class ParticleNet(nn.Module):
         outputs = []
         for idx, conv in enumerate(self.edge_convs):
             pts = (points if idx == 0 else fts) + coord_shift
-            fts = conv(pts, fts) * mask
+            # the neighbours of the first block can be precomputed (see points_knn)
+            fts = conv(pts, fts, knn_idx if idx == 0 else None) * mask
             if self.use_fusion:
                 outputs.append(fts)
         if self.use_fusion:
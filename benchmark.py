@@ -0,0 +1,103 @@
+#!/bin/env python
+import os
+import time
+import tempfile
+import torch
+from magiconfig import ArgumentParser, MagiConfigOptions, ArgumentDefaultsRawHelpFormatter
+from configs import configs as c
+from dataset import getRootDataset, TensorBatchLoader, getBatchLoader, getLoaderOptions, BalancedEpochSampler
+from export import buildModel, getInputFeatureVars, getExampleInputs, traceModel, compileModel, exportONNX, checkExport
+from scoring import ONNXScorer
+
+def benchmarkLoader(loader, maxBatches=None, device=None):
+    # batches per second for one pass over the loader (or its first maxBatches batches), including the copy to the device
+    numBatches = 0
+    start = time.perf_counter()
+    for data in loader:
+        if device is not None:
+            data = [x.to(device, non_blocking=True) for x in data]
+        numBatches += 1
+        if maxBatches is not None and numBatches >= maxBatches:
+            break
+    if device is not None and device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return numBatches / (time.perf_counter() - start)
+
+def benchmarkModel(model, points, features, repeat=10):
+    # mean latency of a forward pass, after a warm-up pass (which also compiles a torch.compile model)
+    with torch.no_grad():
+        model(points, features)
+        start = time.perf_counter()
+        for i in range(repeat):
+            model(points, features)
+    return (time.perf_counter() - start) / repeat
+
+def benchmarkInference(args):
+    # CPU latency of the eager, traced (export.py) and, with torch >= 2.0, compiled tagger,
+    # and with --onnx of the ONNX model run by ONNX Runtime
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model = buildModel(args, args.model)
+    numFeatures = len(getInputFeatureVars(args))
+    numConst = args.hyper.numConst
+    example = getExampleInputs(numFeatures, 8, numConst, numConst // 2)
+    models = {"eager": model, "traced": traceModel(model, *example)}
+    if hasattr(torch, "compile"):
+        models["compiled"] = compileModel(model)
+    if args.onnx:
+        with tempfile.TemporaryDirectory() as tmpDir:
+            fileName = os.path.join(tmpDir, "net.onnx")
+            exportONNX(model, *example, fileName)
+            models["onnx"] = ONNXScorer(fileName, args.threads).probabilities
+        # parity over batch and constituent numbers other than the exported ones
+        maxDiff = checkExport(models["onnx"], model, numFeatures, [(1, numConst, numConst // 3), (100, numConst, numConst), (33, 2 * numConst, numConst)])
+        print("Largest difference of the ONNX model from the eager model: {:.3g}".format(maxDiff))
+    print("{:>10} {:>8} {:>12} {:>12}".format("model", "batch", "latency/ms", "jets/s"))
+    for batchSize in args.batch_sizes:
+        points, features = getExampleInputs(numFeatures, batchSize, numConst, numConst // 2)
+        for name, m in models.items():
+            latency = benchmarkModel(m, points, features, args.repeat)
+            print("{:>10} {:>8} {:>12.2f} {:>12.0f}".format(name, batchSize, 1000 * latency, batchSize / latency))
+
+def main():
+    parser = ArgumentParser(config_options=MagiConfigOptions(strict = True, default="configs/C1.py"),formatter_class=ArgumentDefaultsRawHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4, 8], help="Numbers of DataLoader workers to compare")
+    parser.add_argument("--batches", type=int, default=200, help="Number of batches read per measurement")
+    parser.add_argument("--repeat", type=int, default=2, help="Passes per setting; with persistent workers the later ones do not pay the worker start-up")
+    parser.add_argument("--inference", action="store_true", help="Compare the latency of the eager, traced and compiled tagger on CPU instead of the data loading")
+    parser.add_argument("--model", type=str, default=None, help="Trained weights for --inference (random weights by default)")
+    parser.add_argument("--batch-sizes", dest="batch_sizes", type=int, nargs="+", default=[1, 64, 512], help="Batch sizes for --inference")
+    parser.add_argument("--threads", type=int, default=None, help="Number of CPU threads for --inference")
+    parser.add_argument("--onnx", action="store_true", help="Include the ONNX model run by ONNX Runtime in --inference (needs onnx and onnxruntime)")
+    parser.add_config_only(*c.config_schema)
+    parser.add_config_only(**c.config_defaults)
+    args = parser.parse_args()
+    if args.inference:
+        benchmarkInference(args)
+        return
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    dSet = args.dataset
+    hyper = args.hyper
+    dataset = getRootDataset(args)
+    trainIndices, _, _ = BalancedEpochSampler(dataset.inputFileIndex, dataset.signalFileIndex, sampleFractions=dSet.sample_fractions).epochSplits(0)
+
+    print("{:>24} {:>8} {:>12}".format("loader", "pass", "batches/s"))
+    for numWorkers in args.workers:
+        options = getLoaderOptions(numWorkers, args.training.persistent_workers, args.training.prefetch_factor, args.training.pin_memory)
+        loader = getBatchLoader(dataset, trainIndices, hyper.batchSize, shuffle=True, **options)
+        for i in range(args.repeat):
+            rate = benchmarkLoader(loader, args.batches, device)
+            print("{:>24} {:>8} {:>12.1f}".format("workers={}".format(numWorkers), i, rate))
+        del loader
+    for storage in ["host", "device"]:
+        start = time.perf_counter()
+        loader = TensorBatchLoader(dataset, trainIndices, hyper.batchSize, shuffle=True, device=device, resident=storage == "device")
+        print("{:>24} {:>8} {:>12}".format("epoch_storage=" + storage, "copy", "{:.2f} s".format(time.perf_counter() - start)))
+        for i in range(args.repeat):
+            rate = benchmarkLoader(loader, args.batches, device)
+            print("{:>24} {:>8} {:>12.1f}".format("epoch_storage=" + storage, i, rate))
+        del loader
+
+if __name__ == "__main__":
+    main()
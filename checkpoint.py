@@ -0,0 +1,77 @@
+import os
+import random
+import threading
+import numpy as np
+import torch
+
+def toCPU(obj):
+    # copy of a (nested) state with every tensor copied to the CPU, i.e. a snapshot that training can no longer modify
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, np.ndarray):
+        return obj.copy()
+    if isinstance(obj, dict):
+        return {key: toCPU(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(toCPU(value) for value in obj)
+    return obj
+
+def saveAtomic(state, fileName):
+    # written next to the target and renamed over it, so a job killed while saving leaves the previous file intact
+    tmpName = "{}.tmp{}".format(fileName, os.getpid())
+    torch.save(state, tmpName)
+    os.replace(tmpName, fileName)
+
+def loadState(fileName):
+    # checkpoints hold numpy and python RNG states, which newer torch only unpickles with weights_only=False
+    try:
+        return torch.load(fileName, map_location="cpu", weights_only=False)
+    except TypeError:
+        # torch versions without the weights_only argument
+        return torch.load(fileName, map_location="cpu")
+
+class AsyncCheckpointer:
+    # the states are snapshotted to the CPU in the calling thread and written to disk in a background thread,
+    # so training only waits for the device-to-host copy; at most one set of writes is in flight at a time
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def save(self, states):
+        # states: {fileName: state}
+        self.wait()
+        snapshot = {fileName: toCPU(state) for fileName, state in states.items()}
+        self.thread = threading.Thread(target=self.write, args=(snapshot,))
+        self.thread.start()
+
+    def write(self, snapshot):
+        try:
+            for fileName, state in snapshot.items():
+                saveAtomic(state, fileName)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+def getRNGState():
+    state = {"torch": torch.get_rng_state(), "numpy": np.random.get_state(), "python": random.getstate()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+def setRNGState(state):
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["python"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+def isCheckpoint(state):
+    # full training checkpoints, as opposed to a bare model state_dict such as net.pth
+    return isinstance(state, dict) and "model" in state and "optimizer" in state
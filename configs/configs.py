@@ -5,14 +5,23 @@ def make_schema(config_schema_dict):
 
 # define schema of config parameters
 config_schema_dict = {
-    "dataset":  ["path","signal","background","sample_fractions"],
+    "dataset":  ["path","signal","background","sample_fractions","cache","memmap","read_workers","max_constituents","max_jets","jagged","float16","streaming","stream_jets_per_epoch","shuffle_buffer","precompute_knn"],
     "features": ["uniform","weight","mT","train","spectator"],
-    "training": ["size","signal_id_method","signal_weight_method","weights","algorithms"],
-    "hyper":    ["learning_rate","batchSize","numConst","num_of_k_nearest","num_of_edgeConv_dim","num_of_edgeConv_convLayers","num_of_fc_layers","num_of_fc_nodes","fc_dropout","epochs","lambdaTag","lambdaReg","lambdaGR","lambdaDC","pTBins","n_pTBins","rseed","max_depth","n_estimators","subsample","min_samples_leaf","fl_coefficient","power","uniform_label","n_bins","uloss"],
+    "training": ["size","signal_id_method","signal_weight_method","weights","algorithms","profile_every","profile_file","epoch_storage","num_workers","persistent_workers","prefetch_factor","pin_memory","val_every","val_size","early_stopping","patience","precision","accum_steps","bucketing"],
+    "hyper":    ["learning_rate","batchSize","numConst","num_of_k_nearest","num_of_edgeConv_dim","num_of_edgeConv_convLayers","num_of_fc_layers","num_of_fc_nodes","fc_dropout","epochs","lambdaTag","lambdaReg","lambdaGR","lambdaDC","pTBins","n_pTBins","rseed","max_depth","n_estimators","subsample","min_samples_leaf","fl_coefficient","power","uniform_label","n_bins","uloss","lean_edgeconv"],
 }
 config_schema = make_schema(config_schema_dict)
 
 # include a default value and some required
 config_defaults = {
-    "dataset.path": None, "dataset.background": None, "dataset.signal": None
+    "dataset.path": None, "dataset.background": None, "dataset.signal": None,
+    "dataset.cache": None, "dataset.memmap": False, "dataset.read_workers": None,
+    "dataset.max_constituents": 105238, "dataset.max_jets": None, "dataset.jagged": False, "dataset.float16": False,
+    "dataset.streaming": False, "dataset.stream_jets_per_epoch": None, "dataset.shuffle_buffer": 10000,
+    "dataset.precompute_knn": False,
+    "training.profile_every": 0, "training.profile_file": None, "training.epoch_storage": None,
+    "training.num_workers": 0, "training.persistent_workers": False, "training.prefetch_factor": 2, "training.pin_memory": False,
+    "training.val_every": 1, "training.val_size": None, "training.early_stopping": None, "training.patience": 5,
+    "training.precision": "fp32", "training.accum_steps": 1, "training.bucketing": False,
+    "hyper.lean_edgeconv": False,
 }
@@ -1,3 +1,10 @@
+import os
+import json
+import copy
+import shutil
+import hashlib
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import uproot as up
 from magiconfig import ArgumentParser, MagiConfigOptions, ArgumentDefaultsRawHelpFormatter
@@ -6,66 +13,97 @@ import torch.utils.data as udata
 import torch
 import pandas as pd
 from tqdm import tqdm
+from ParticleNet import get_mask, points_knn
 
-def getParticleNetInputs(dataSet,signalFileIndex,numConst):
+darkHvCategories = [3, 5, 9] # jCsthvCategory values of signal constituents coming from the dark shower
+maxConstituentsPerFile = 105238 # default per-file budget, the lowest number of constituents among the training files
+readStepSize = 100000 # number of entries read from a tree at a time
+cacheVersion = 8 # bump whenever the preprocessing changes in a way that invalidates existing caches
+cacheFields = ["signal","mcType","pTLab","pTs","mTs","weights","mMeds","mDarks","rinvs","alphas","normNames","normCount","normMean","normM2","inputFileIndex","signalFileIndex","jetSizes"]
+paddedFields = ["points","features"] # (n_jets, n_var, numConst) arrays
+jaggedFields = ["constPoints","constFeatures","jetOffsets"] # flat (n_const, n_var) arrays plus per-jet offsets
+
+def padJets(constValues, jetOffsets, numConst, jets=None):
+    # scatter the constituents of the selected jets from the flat (n_const, n_var) table into (n_jets, n_var, numConst),
+    # zero-padding short jets and dropping constituents beyond numConst
+    if jets is None:
+        jets = np.arange(len(jetOffsets)-1)
+    starts = jetOffsets[jets]
+    sizes = np.minimum(jetOffsets[jets+1] - starts, numConst)
+    jetOfConst = np.repeat(np.arange(len(jets)), sizes)
+    posInJet = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    padded = np.zeros((len(jets), constValues.shape[1], numConst), dtype=constValues.dtype)
+    padded[jetOfConst, :, posInJet] = constValues[starts[jetOfConst] + posInJet]
+    return padded
+
+def getKnnIndices(constPoints, constFeatures, jetOffsets, numConst, k, jets=None, chunkSize=4096):
+    # (n_jets, numConst, k) neighbours of every constituent in the first EdgeConv block, which only depend on
+    # the fixed (eta, phi) coordinates: computed once per jet, in chunks of jets, exactly as the model would
+    if jets is None:
+        jets = np.arange(len(jetOffsets)-1)
+    knnIdx = np.empty((len(jets), numConst, k), dtype=np.uint8 if numConst <= 256 else np.int16)
+    for start in range(0, len(jets), chunkSize):
+        chunk = jets[start:start+chunkSize]
+        points = torch.from_numpy(padJets(constPoints, jetOffsets, numConst, chunk)).float()
+        features = torch.from_numpy(padJets(constFeatures, jetOffsets, numConst, chunk)).float()
+        with torch.no_grad():
+            knnIdx[start:start+len(chunk)] = points_knn(points, get_mask(features), k).numpy()
+    return knnIdx
+
+def trimKnn(knnIdx, length):
+    # precomputed neighbours cut to length constituents: neighbours beyond length can only be padding
+    # (of jets with fewer than k+1 constituents, with length >= k+1), and so is the last position kept for them
+    if knnIdx.shape[-1] == 0:
+        return knnIdx
+    return knnIdx[..., :length, :].clamp(max=length-1)
+
+def trimBatch(batch, length):
+    # cuts the padding of a batch of items to length constituents
+    batch = list(batch)
+    batch[1] = batch[1][..., :length]
+    batch[2] = batch[2][..., :length]
+    batch[12] = trimKnn(batch[12], length)
+    return tuple(batch)
+
+def bucketBatches(sizes, batchSize, shuffle=False, generator=None, poolBatches=50):
+    # splits the positions 0..len(sizes)-1 into batches of jets with similar numbers of constituents: the positions
+    # are (shuffled,) sorted by size within pools of poolBatches batches and cut into batches, whose order is
+    # shuffled again. There are as many batches as without bucketing
+    order = torch.randperm(len(sizes), generator=generator).numpy() if shuffle else np.arange(len(sizes))
+    batches = []
+    for start in range(0, len(order), batchSize * poolBatches):
+        pool = order[start:start+batchSize*poolBatches]
+        pool = pool[np.argsort(sizes[pool], kind="stable")]
+        batches += [pool[i:i+batchSize] for i in range(0, len(pool), batchSize)]
+    if shuffle:
+        batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).numpy()]
+    return batches
+
+def getParticleNetInputs(dataSet,jetOffsets,signalFileIndex,normStats):
     varSet = dataSet.columns.tolist()
-    data = dataSet.to_numpy()
     evtNumIndex = varSet.index("jCstEvtNum")
     fJetNumIndex = varSet.index("jCstJNum")
     etaIndex = varSet.index("jCstEta")
     phiIndex = varSet.index("jCstPhi")
     inFileIndex = varSet.index("inputFile")
     hvIndex = varSet.index("jCsthvCategory")
-    jIDIndex = varSet.index("jID")
-    evtNumColumn = data[:,evtNumIndex]
-    fJetNumColumn = data[:,fJetNumIndex]
-    inFileColumn = data[:,inFileIndex]
-    inFColumn = data[:,inFileIndex]
-    jIDColumn = data[:,jIDIndex]
-
-    inputPoints = []
-    inputFeatures = []
-    inputFileIndices = []
-    # grouping constituents that belong to the same jet together
-    print("There are {} unique jets.".format(len(np.unique(jIDColumn))))
-    count = 1
-    signal = []
-    for jID in np.unique(jIDColumn):
-        if count % 200 == 0:
-            print("Transformed {} jets".format(count))
-        count += 1
-        sameJetConstData = data[jIDColumn == jID] # getting values for constituents in the same jet
-        if sameJetConstData[0][inFileIndex] in signalFileIndex:
-            signal.append([0, 1])
-        else:
-            signal.append([1, 0])
-        sameJetConstDataTr = np.transpose(sameJetConstData)
-        if numConst > sameJetConstDataTr.shape[1]:
-            paddedJetConstData = np.pad(sameJetConstDataTr,((0,0),(0,numConst-sameJetConstDataTr.shape[1])), 'constant', constant_values=0)
-        else:
-            paddedJetConstData = sameJetConstDataTr[:,:numConst]
-        eachJetPoints = np.array([paddedJetConstData[etaIndex],paddedJetConstData[phiIndex]])
-        eachJetFeatures = []
-        for i in range(paddedJetConstData.shape[0]):
-            # make sure information that would easily give away the identity of the jet is not included as input features
-            if i not in [etaIndex,phiIndex,evtNumIndex,fJetNumIndex,inFileIndex,hvIndex,jIDIndex]:
-                eachJetFeatures.append(paddedJetConstData[i])
-        inputPoints.append(eachJetPoints)
-        inputFeatures.append(eachJetFeatures)
-        inputFileIndices.append(inFileColumn[jIDColumn == jID][0])
-    inputPoints = np.array(inputPoints)
-    inputFeatures = np.array(inputFeatures)
+    # make sure information that would easily give away the identity of the jet is not included as input features
+    featureIndices = [i for i in range(len(varSet)) if i not in [etaIndex,phiIndex,evtNumIndex,fJetNumIndex,inFileIndex,hvIndex]]
+    # the constituents of jet i are the rows jetOffsets[i]:jetOffsets[i+1] of the table
+    numJets = len(jetOffsets) - 1
+    print("There are {} unique jets.".format(numJets))
+    # only the inputs are converted, straight to float32, rather than the whole table to float64
+    constPoints = dataSet.iloc[:, [etaIndex, phiIndex]].to_numpy(dtype=np.float32)
+    constFeatures = dataSet.iloc[:, featureIndices].to_numpy(dtype=np.float32)
+    applyNormStats(constFeatures, [varSet[i] for i in featureIndices], normStats)
+    inputFileIndices = dataSet.iloc[jetOffsets[:-1], inFileIndex].to_numpy().astype(np.int16)
+    signal = np.isin(inputFileIndices, signalFileIndex).astype(np.uint8) # 1 for signal jets, 0 for background
     print("There are {} labels.".format(len(signal)))
-    print(inputPoints.shape)
-    print(inputFeatures.shape)
-    return inputPoints, inputFeatures, signal, inputFileIndices
-
-def getBranch(ftree,variable,branches,branchList):
-    branch = ftree.arrays(variable,library="pd")
-    branch = branch.head(len(branches))
-    branchList.append(branch)
+    print(constPoints.shape)
+    print(constFeatures.shape)
+    return constPoints, constFeatures, signal, inputFileIndices
 
-def getPara(fileName,paraName,paraList,branches,key):
+def getPara(fileName,paraName,key):
     paravalue = 0
     if key == "signal":
         ind = fileName.find(paraName)
@@ -81,155 +119,264 @@ def getPara(fileName,paraName,paraList,branches,key):
                 paravalue = 3
         else:
             paravalue = float(paravalue)
-    paraList += [paravalue]*len(branches)
-
-def normalize(df):
-    return (df-df.mean())/df.std()
-
-def jetIdentifier(dataSet):
-    dataSet["jID"] = (dataSet["jCstEvtNum"].astype(int))*10**6 + (dataSet["inputFile"].astype(int))*1000 + dataSet["jCstJNum"].astype(int)
-
-def get_all_vars(inputFolder, samples, variables, pTBins, uniform, mT, weight, numConst, tree="tree"):
-    dSets = []
-    signal = []
-    mcType =[] # 0 = signals other than baseline, 1 = baseline signal, 2 = QCD, 3 = TTJets
-    pTLab = np.array([])
-    pTs = []
-    mTs = []
-    mMeds = []
-    mDarks = []
-    rinvs = []
-    alphas = []
-    weights = []
-    fileIndex = 0
+    return paravalue
+
+def getNormColumns(variables):
+    return [var for var in variables if var not in ["jCstEta","jCstPhi","inputFile","jCstEvtNum","jCstJNum"]]
+
+def getNormStats(branches, columns):
+    # count, mean and sum of squared deviations from the mean of each column; these can be merged across files
+    values = branches[columns].to_numpy(dtype=float)
+    if len(values) == 0:
+        return {"names": np.array(columns), "count": 0, "mean": np.zeros(len(columns)), "m2": np.zeros(len(columns))}
+    mean = values.mean(axis=0)
+    return {"names": np.array(columns), "count": len(values), "mean": mean, "m2": ((values - mean)**2).sum(axis=0)}
+
+def mergeNormStats(statsList):
+    # pairwise update of Chan et al., exact up to rounding whatever the order of the files
+    merged = statsList[0]
+    for stats in statsList[1:]:
+        if stats["count"] == 0:
+            continue
+        count = merged["count"] + stats["count"]
+        delta = stats["mean"] - merged["mean"]
+        mean = merged["mean"] + delta * stats["count"] / count
+        m2 = merged["m2"] + stats["m2"] + delta**2 * merged["count"] * stats["count"] / count
+        merged = {"names": merged["names"], "count": count, "mean": mean, "m2": m2}
+    return merged
+
+def getNormStd(stats):
+    # sample standard deviation, as pandas' DataFrame.std
+    return np.sqrt(stats["m2"] / (stats["count"] - 1))
+
+def applyNormStats(values, names, stats):
+    # normalize the columns of values (n_rows, n_columns) in place
+    statNames = list(stats["names"])
+    std = getNormStd(stats)
+    for i, name in enumerate(names):
+        if name in statNames:
+            j = statNames.index(name)
+            values[:, i] -= stats["mean"][j]
+            values[:, i] /= std[j]
+
+def saveNormStats(fileName, stats):
+    # normMean and normStd are kept for anything reading the older file format
+    np.savez(fileName, names=stats["names"], count=stats["count"], mean=stats["mean"], m2=stats["m2"], normMean=stats["mean"], normStd=getNormStd(stats))
+
+def loadNormStats(fileName):
+    with np.load(fileName) as saved:
+        if "names" not in saved.files:
+            print("No per-variable statistics in {}, written by an older version".format(fileName))
+            return None
+        return {"names": saved["names"], "count": int(saved["count"]), "mean": saved["mean"], "m2": saved["m2"]}
+
+def jetStarts(evtNum, jNum):
+    # constituents of a jet are stored next to each other, so a new jet starts wherever (evtNum, jNum) changes
+    starts = np.ones(len(evtNum), dtype=bool)
+    starts[1:] = (evtNum[1:] != evtNum[:-1]) | (jNum[1:] != jNum[:-1])
+    return starts
+
+def truncateAtJetBoundary(branches, maxConstituents=None, maxJets=None):
+    jetNumber = np.cumsum(jetStarts(branches["jCstEvtNum"].to_numpy(), branches["jCstJNum"].to_numpy())) - 1
+    numKeep = len(branches)
+    if maxConstituents is not None and numKeep > maxConstituents:
+        # the jet of the first constituent over the budget would be incomplete, so it is dropped entirely
+        numKeep = np.searchsorted(jetNumber, jetNumber[maxConstituents])
+    if maxJets is not None:
+        numKeep = min(numKeep, np.searchsorted(jetNumber, maxJets))
+    return branches.iloc[:numKeep]
+
+def getBranchNames(key, variables, uniform, mT, weight):
+    # the union of all the branches we need, read in a single pass over the tree
+    return list(dict.fromkeys(list(variables) + [uniform, mT, weight] + (["jCsthvCategory"] if key == "signal" else [])))
+
+def iterateFile(inputFolder, key, fileName, variables, uniform, mT, weight, tree="tree"):
+    # yields the constituents of a file chunk by chunk, after the hvCategory filter and the inf/NaN removal
+    f = up.open(inputFolder  + fileName + ".root")
+    ftree = f[tree]
+    branchNames = getBranchNames(key, variables, uniform, mT, weight)
+    for branches in ftree.iterate(branchNames,step_size=readStepSize,library="pd"):
+        if key == "signal":
+            darkCon = branches["jCsthvCategory"].isin(darkHvCategories)
+            # print(branches['jCsthvCategory'].value_counts())
+            branches = branches[darkCon]
+        branches = branches.replace([np.inf, -np.inf], np.nan)
+        branches = branches.dropna(subset=list(variables))
+        if len(branches) == 0:
+            continue
+        yield branches
+
+def processConstituents(branches, key, fileName, fileIndex, variables, pTBins, uniform, mT, weight):
+    numConstituents = len(branches)
+    jetStartRows = np.flatnonzero(jetStarts(branches["jCstEvtNum"].to_numpy(), branches["jCstJNum"].to_numpy()))
+    jetSizes = np.diff(np.append(jetStartRows, numConstituents))
+    numJets = len(jetStartRows)
+    # jet-level spectators are taken from the first constituent of each jet
+    pT = branches[uniform].to_numpy(dtype=float)[jetStartRows]
+    spectators = {
+        "pT": pT.astype(np.float32),
+        "mT": branches[mT].to_numpy(dtype=np.float32)[jetStartRows],
+        "weight": branches[weight].to_numpy(dtype=np.float32)[jetStartRows],
+        # get the pT label based on what pT bin the jet pT falls into
+        "pTLab": (np.digitize(pT,pTBins) - 1).astype(np.int16),
+    }
+    if key == "signal":
+        if fileName == "tree_SVJ_mZprime-3000_mDark-20_rinv-0.3_alpha-peak_MC2017":
+            mcType = 1
+        else:
+            mcType = 0
+    else:
+        if "QCD" in fileName:
+            mcType = 2
+        else:
+            mcType = 3
+    spectators["mcType"] = np.full(numJets, mcType, dtype=np.uint8)
+    # spectators["mMed"] = np.full(numJets, getPara(fileName,"mZprime",key), dtype=np.float32)
+    spectators["mMed"] = np.full(numJets, getPara(fileName,"mMed",key), dtype=np.float32) # use this for t-channel
+    spectators["mDark"] = np.full(numJets, getPara(fileName,"mDark",key), dtype=np.float32)
+    spectators["rinv"] = np.full(numJets, getPara(fileName,"rinv",key), dtype=np.float32)
+    spectators["alpha"] = np.full(numJets, getPara(fileName,"alpha",key), dtype=np.uint8)
+    # keep the column order uproot gives us, it sets the order of the input features
+    branches = branches[[var for var in branches.columns if var in variables]].assign(inputFile=fileIndex) # record name of the input file, important for distinguishing which jet the constituents belong to
+    return branches, spectators, jetSizes
+
+def readFile(inputFolder, key, fileName, fileIndex, variables, pTBins, uniform, mT, weight, maxConstituents=maxConstituentsPerFile, maxJets=None, tree="tree"):
+    print(fileName)
+    # read the tree chunk by chunk and stop as soon as the per-file budget is exceeded,
+    # so memory and I/O scale with what we keep rather than with the size of the file
+    chunks = []
+    numConstituents = 0
+    numJets = 0
+    lastJet = None
+    for branches in iterateFile(inputFolder, key, fileName, variables, uniform, mT, weight, tree):
+        evtNum = branches["jCstEvtNum"].to_numpy()
+        jNum = branches["jCstJNum"].to_numpy()
+        starts = jetStarts(evtNum, jNum)
+        if lastJet == (evtNum[0], jNum[0]):
+            starts[0] = False # jet continued from the previous chunk
+        lastJet = (evtNum[-1], jNum[-1])
+        chunks.append(branches)
+        numConstituents += len(branches)
+        numJets += np.count_nonzero(starts)
+        # once a constituent (or jet) beyond the budget has been read, every jet before it is complete
+        if (maxConstituents is not None and numConstituents > maxConstituents) or (maxJets is not None and numJets > maxJets):
+            break
+    if chunks:
+        branches = pd.concat(chunks)
+    else:
+        # every constituent was filtered out: an empty table, which gives no jets
+        branches = pd.DataFrame({name: np.empty(0) for name in getBranchNames(key, variables, uniform, mT, weight)})
+    del chunks
+    branches = truncateAtJetBoundary(branches, maxConstituents, maxJets)
+    print("Total Number of constituents for {}".format(fileName))
+    print(len(branches))
+    branches, spectators, jetSizes = processConstituents(branches, key, fileName, fileIndex, variables, pTBins, uniform, mT, weight)
+    print("Number of Constituents",len(branches))
+    return branches, spectators, jetSizes, getNormStats(branches, getNormColumns(variables))
+
+def listInputFiles(samples):
+    keys = []
+    fileNames = []
     signalFileIndex = []
     for key,fileList in samples.items():
-        nsigfiles = len(samples["signal"])
-        nbkgfiles = len(samples["background"])
         for fileName in fileList:
-            print(fileName)
-            f = up.open(inputFolder  + fileName + ".root")
-            ftree = f[tree]
-            branches = ftree.arrays(variables,library="pd")
-            if key == "signal":
-                signalFileIndex.append(fileIndex)
-                jetCatBranch = ftree.arrays("jCsthvCategory",library="pd")
-                darkCon = ((jetCatBranch["jCsthvCategory"] == 3) | (jetCatBranch["jCsthvCategory"] == 5) | (jetCatBranch["jCsthvCategory"] == 9))
-                # print(jetCatBranch['jCsthvCategory'].value_counts())
-                branches = branches[darkCon]
-            branches["inputFile"] = [fileIndex]*len(branches) # record name of the input file, important for distinguishing which jet the constituents belong to
-            fileIndex += 1
-            branches.replace([np.inf, -np.inf], np.nan, inplace=True)
-            branches = branches.dropna()
-            numEvent = len(branches)
-            minNum = 105238 # 105238
-            maxMultiple = 1
-            maxNum = minNum * maxMultiple # using 105238 for lowest number of constituents from the training
-            # if we do not limit the number of constituents we read in, the code is gonna take very long to run
-            if numEvent > maxNum:
-                numEvent = maxNum
-            elif minNum < numEvent < maxNum:
-                factor = numEvent//minNum
-                numEvent = factor*minNum # make sure the number of constituents we keep are multiples of the minNum
-            branches = branches.head(numEvent)
-            print("Total Number of constituents for {}".format(fileName))
-            print(len(branches))
-            # print(len(branches))
-            # branches = branches.head(10000)
-            dSets.append(branches)
-            getBranch(ftree,uniform,branches,pTs)
-            getBranch(ftree,mT,branches,mTs)
-            getBranch(ftree,weight,branches,weights)
-            # getPara(fileName,"mZprime",mMeds,branches,key)
-            getPara(fileName,"mMed",mMeds,branches,key) # use this for t-channel
-            getPara(fileName,"mDark",mDarks,branches,key)
-            getPara(fileName,"rinv",rinvs,branches,key)
-            getPara(fileName,"alpha",alphas,branches,key)
-            # get the pT label based on what pT bin the jet pT falls into
-            branch = ftree.arrays(uniform,library="pd")
-            branch = branch.head(len(branches)).to_numpy().flatten()
-            pTLabel = np.digitize(branch,pTBins) - 1.0
-            pTLab = np.append(pTLab,pTLabel)
             if key == "signal":
-                signal += list([0, 1] for _ in range(len(branches)))
-                if fileName == "tree_SVJ_mZprime-3000_mDark-20_rinv-0.3_alpha-peak_MC2017":
-                    mcType += [1] * len(branches)
-                else:
-                    mcType += [0] * len(branches)
-            else:
-                signal += list([1, 0] for _ in range(len(branches)))
-                if "QCD" in fileName:
-                    mcType += [2] * len(branches)
-                else:
-                    mcType += [3] * len(branches)
-            print("Number of Constituents",len(branches))
-    mcType = np.array(mcType)
-    mMed = np.array(mMeds)
-    mDark = np.array(mDarks)
-    rinv = np.array(rinvs)
-    alpha = np.array(alphas)
-    dataSet = pd.concat(dSets)
-    jetIdentifier(dataSet)
+                signalFileIndex.append(len(fileNames))
+            keys.append(key)
+            fileNames.append(fileName)
+    return keys, fileNames, signalFileIndex
+
+def get_all_vars(inputFolder, samples, variables, pTBins, uniform, mT, weight, numConst, tree="tree", readWorkers=None, maxConstituents=maxConstituentsPerFile, maxJets=None, normStats=None):
+    # mcType: 0 = signals other than baseline, 1 = baseline signal, 2 = QCD, 3 = TTJets
+    keys, fileNames, signalFileIndex = listInputFiles(samples)
+    fileIndices = list(range(len(fileNames)))
+    readOneFile = partial(readFile, inputFolder, variables=variables, pTBins=pTBins, uniform=uniform, mT=mT, weight=weight, maxConstituents=maxConstituents, maxJets=maxJets, tree=tree)
+    if readWorkers == 1:
+        results = list(map(readOneFile, keys, fileNames, fileIndices))
+    else:
+        # map returns the per-file results in file-index order, whatever order the workers finish in
+        with ProcessPoolExecutor(max_workers=readWorkers) as executor:
+            results = list(executor.map(readOneFile, keys, fileNames, fileIndices))
+    # empty files are left out, so that their (float) columns do not change the types of the others
+    tables = [branches for branches, _, _, _ in results]
+    dataSet = pd.concat([branches for branches in tables if len(branches) > 0] or tables)
+    del tables
+    spectators = {name: np.concatenate([spec[name] for _, spec, _, _ in results]) for name in results[0][1]}
+    # jets are grouped per file, so they never span two input files
+    jetOffsets = np.concatenate([[0], np.cumsum(np.concatenate([jetSizes for _, _, jetSizes, _ in results]))])
+    # statistics saved with a trained model are reused as they are, so that the inputs are
+    # normalized the same way whatever sample is being evaluated
+    if normStats is None:
+        normStats = mergeNormStats([fileStats for _, _, _, fileStats in results])
+    del results
     print("dataSet.head()")
     print(dataSet.head())
     print("The number of constituents in each input training file:")
     print(dataSet["inputFile"].value_counts())
-    dfmean = dataSet.mean()
-    dfstd = dataSet.std()
     dataSet["jCstEta_Norm"] = dataSet["jCstEta"]
     dataSet["jCstPhi_Norm"] = dataSet["jCstPhi"]
-    columns_to_normalize = [var for var in variables if var not in ["jCstEta","jCstPhi","inputFile","jCstEvtNum","jCstJNum"]]
-    dataSet[columns_to_normalize] = normalize(dataSet[columns_to_normalize])
-    pT = pd.concat(pTs)
-    mT = pd.concat(mTs)
-    weight = pd.concat(weights)
-    inputPoints, inputFeatures, signal, inputFileIndices = getParticleNetInputs(dataSet,signalFileIndex,numConst)
-    sigLabel = np.array(signal)[:,1]
-    print("The total number of jets: {}".format(len(sigLabel)))
-    print("Total number of signal jets: {}".format(len(sigLabel[sigLabel==1])))
-    print("Total number of background jets: {}".format(len(sigLabel[sigLabel==0])))
-    return [inputPoints,inputFeatures,signal,mcType,pTLab,pT,mT,weight,mMed,mDark,rinv,alpha,dfmean,dfstd,inputFileIndices,signalFileIndex]
-
-def splitArrayByChunkSize(alist,chunkSize):
-    if chunkSize > len(alist):
-        chunkSize = len(alist)
-    numOfChunks = len(alist) // chunkSize
-    aListChunks = []
-    start = 0
-    for i in range(numOfChunks):
-        end = start + chunkSize
-        aListChunks.append(alist[start:end])
-        start = end
-    return aListChunks
-
-def splitDataSetEvenly(dataset,rng,numOfEpoch=10):
-    inputFileIndex = dataset.inputFileIndex
-    signalFileIndex = dataset.signalFileIndex
-    listIndices = np.arange(len(inputFileIndex))
-    inputFileIndex = np.array(inputFileIndex)
-    minOcc = np.amin(np.unique(inputFileIndex,return_counts=True)[1])
-    uniqueFileIndices = np.unique(inputFileIndex)
-    numOfSigFiles = len(signalFileIndex)
-    numOfBkgFiles = len(uniqueFileIndices) - numOfSigFiles
-    allSamplesIndices = []
-    numOfSets = []
-    for i in uniqueFileIndices:
-        chunkSize = minOcc
-        subIndexList = listIndices[inputFileIndex==i]
-        rng.shuffle(subIndexList)
-        if i not in signalFileIndex:
-            chunkSize = int(minOcc*(numOfSigFiles/numOfBkgFiles)) # this is assuming there are more background events than signal events in general
-        indexSet = splitArrayByChunkSize(subIndexList,chunkSize)
-        allSamplesIndices.append(indexSet)
-        numOfSets.append(len(indexSet))
-    randBalancedSet = []
-    for i in range(numOfEpoch):
-        randomIndexSet = [rng.randint(0,high=ind) for ind in numOfSets]
-        indicesForEpoch = np.array([],dtype=int)
-        for j in range(len(allSamplesIndices)):
-            indicesForEpoch = np.concatenate((indicesForEpoch,allSamplesIndices[j][randomIndexSet[j]]))
-        randBalancedSet.append(indicesForEpoch)
-    return randBalancedSet
+    constPoints, constFeatures, signal, inputFileIndices = getParticleNetInputs(dataSet,jetOffsets,signalFileIndex,normStats)
+    print("The total number of jets: {}".format(len(signal)))
+    print("Total number of signal jets: {}".format(np.count_nonzero(signal==1)))
+    print("Total number of background jets: {}".format(np.count_nonzero(signal==0)))
+    return [constPoints,constFeatures,jetOffsets,signal,spectators["mcType"],spectators["pTLab"],spectators["pT"],spectators["mT"],spectators["weight"],spectators["mMed"],spectators["mDark"],spectators["rinv"],spectators["alpha"],normStats,inputFileIndices,signalFileIndex]
+
+def getCacheKey(inputFolder, samples, variables, pTBins, uniform, mT, weight, numConst, maxConstituents, maxJets, jagged, float16=False, normStats=None, knnK=None):
+    # local input files are identified by their modification time and size as well,
+    # so that a regenerated training file invalidates the cache
+    inputInfo = []
+    for key,fileList in samples.items():
+        for fileName in fileList:
+            filePath = inputFolder + fileName + ".root"
+            if os.path.isfile(filePath):
+                fileStat = os.stat(filePath)
+                inputInfo.append([key, filePath, fileStat.st_mtime, fileStat.st_size])
+            else:
+                inputInfo.append([key, filePath]) # remote (e.g. xrootd) file, identified by name only
+    keyInfo = {
+        "version": cacheVersion,
+        "inputs": inputInfo,
+        "variables": list(variables),
+        "numConst": numConst,
+        "pTBins": list(pTBins),
+        "uniform": uniform,
+        "mT": mT,
+        "weight": weight,
+        "hvCategories": darkHvCategories,
+        "maxConstituents": maxConstituents,
+        "maxJets": maxJets,
+        "jagged": jagged,
+        "float16": float16,
+        "normStats": None if normStats is None else [list(normStats["names"]), normStats["count"], list(map(float, normStats["mean"])), list(map(float, normStats["m2"]))],
+    }
+    if knnK is not None:
+        keyInfo["knnK"] = knnK
+    return hashlib.sha1(json.dumps(keyInfo, sort_keys=True).encode()).hexdigest()
+
+def hasNormStats(cachePath, normStats):
+    # whether a cache entry was normalized with exactly these statistics
+    cached = {field: np.load(os.path.join(cachePath, field + ".npy")) for field in ["normNames", "normCount", "normMean", "normM2"]}
+    return list(cached["normNames"]) == list(normStats["names"]) and int(cached["normCount"]) == normStats["count"] and np.array_equal(cached["normMean"], normStats["mean"]) and np.array_equal(cached["normM2"], normStats["m2"])
+
+def saveCache(cachePath, arrays):
+    # write into a temporary directory first, so that an interrupted job never leaves a partial cache behind
+    tmpPath = "{}.tmp{}".format(cachePath, os.getpid())
+    os.makedirs(tmpPath)
+    for field, values in arrays.items():
+        np.save(os.path.join(tmpPath, field + ".npy"), values)
+    try:
+        os.rename(tmpPath, cachePath)
+    except OSError:
+        # another job filled the same cache entry in the meantime
+        shutil.rmtree(tmpPath)
+    print("Saved preprocessed dataset to cache", cachePath)
+
+def loadCache(cachePath, fields, memmap=False):
+    print("Loading preprocessed dataset from cache", cachePath)
+    # copy-on-write maps share the page cache between all processes reading the same cache entry
+    # and are writable, so torch.from_numpy can wrap them without a copy
+    mmapMode = "c" if memmap else None
+    return {field: np.load(os.path.join(cachePath, field + ".npy"), mmap_mode=mmapMode) for field in fields}
 
 def get_sizes(l, frac=[0.8, 0.1, 0.1]):
     if sum(frac) != 1.0: raise ValueError("Sum of fractions does not equal 1.0")
@@ -239,74 +386,608 @@ def get_sizes(l, frac=[0.8, 0.1, 0.1]):
     val_size = l - train_size - test_size
     return [train_size, test_size, val_size]
 
+def splitIndices(indices, frac, seed=42):
+    # same permutation as udata.random_split with a generator seeded by seed,
+    # but returns the dataset indices of each subset instead of Subset objects
+    indices = np.asarray(indices)
+    sizes = get_sizes(len(indices), frac)
+    perm = torch.randperm(len(indices), generator=torch.Generator().manual_seed(seed)).numpy()
+    subsets = []
+    start = 0
+    for size in sizes:
+        subsets.append(indices[perm[start:start+size]])
+        start += size
+    return subsets
+
+class BalancedEpochSampler(udata.Sampler):
+    # balanced epoch sets generated on demand: the jets of every file are shuffled once and cut into chunks,
+    # the size of the smallest file for signal files and making up as many jets in total for background files;
+    # an epoch takes one chunk of every file, chosen from the seed and the epoch number only. Only the shuffled
+    # table of all the jets is stored, whatever the number of epochs.
+    # Iterating gives the indices of one subset (split) of the current epoch (set_epoch), sharded over
+    # rank/worldSize (distributed processes, or any other consumers splitting the work)
+    splits = ["train","val","test"]
+
+    def __init__(self, inputFileIndex, signalFileIndex, seed=2022, split="train", sampleFractions=[0.8,0.1,0.1], rank=0, worldSize=1):
+        self.seed = seed
+        self.split = split
+        self.sampleFractions = sampleFractions
+        self.rank = rank
+        self.worldSize = worldSize
+        self.epoch = 0
+        self.heldOut = None
+        inputFileIndex = np.asarray(inputFileIndex)
+        fileIndices, counts = np.unique(inputFileIndex, return_counts=True)
+        minOcc = np.amin(counts)
+        numOfSigFiles = len(signalFileIndex)
+        numOfBkgFiles = len(fileIndices) - numOfSigFiles
+        rng = np.random.RandomState(seed)
+        # jets grouped by file, each group shuffled in place
+        self.table = np.argsort(inputFileIndex, kind="stable")
+        self.starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        self.chunkSizes = np.empty(len(fileIndices), dtype=np.int64)
+        for i, (fileIndex, count) in enumerate(zip(fileIndices, counts)):
+            rng.shuffle(self.table[self.starts[i]:self.starts[i]+count])
+            chunkSize = minOcc
+            if fileIndex not in signalFileIndex:
+                chunkSize = int(minOcc*(numOfSigFiles/numOfBkgFiles)) # this is assuming there are more background events than signal events in general
+            self.chunkSizes[i] = min(max(chunkSize, 1), count)
+        self.numChunks = counts // self.chunkSizes
+        self.epochSize = int(self.chunkSizes.sum())
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def epochIndices(self, epoch):
+        # one randomly chosen chunk of every file
+        chunks = np.random.RandomState([self.seed, epoch]).randint(0, self.numChunks)
+        indices = np.empty(self.epochSize, dtype=np.int64)
+        pos = 0
+        for start, chunkSize, chunk in zip(self.starts, self.chunkSizes, chunks):
+            indices[pos:pos+chunkSize] = self.table[start+chunk*chunkSize:start+(chunk+1)*chunkSize]
+            pos += chunkSize
+        return indices
+
+    def shard(self, indices):
+        # every shard gets the same number of indices
+        return indices[:len(indices) // self.worldSize * self.worldSize][self.rank::self.worldSize]
+
+    def epochSplits(self, epoch):
+        # train, val and test indices of the epoch for this shard
+        splits = splitIndices(self.epochIndices(epoch), self.sampleFractions)
+        if self.heldOut is not None:
+            splits[0] = splits[0][~self.heldOut[splits[0]]]
+        return [self.shard(indices) for indices in splits]
+
+    def holdOut(self, epoch=0, split="val", maxSize=None):
+        # fixes (at most maxSize jets of) one split of an epoch as a held-out set, e.g. for validation:
+        # its jets are left out of the training split of every epoch. Returns this shard's part of it
+        indices = splitIndices(self.epochIndices(epoch), self.sampleFractions)[self.splits.index(split)][:maxSize]
+        self.heldOut = np.zeros(len(self.table), dtype=bool)
+        self.heldOut[indices] = True
+        return self.shard(indices)
+
+    def __iter__(self):
+        return iter(self.epochSplits(self.epoch)[self.splits.index(self.split)].tolist())
+
+    def __len__(self):
+        # the training split of each epoch loses the held-out jets it happens to contain, so its size depends on the epoch
+        if self.heldOut is None:
+            size = len(splitIndices(np.arange(self.epochSize), self.sampleFractions)[self.splits.index(self.split)])
+            return size // self.worldSize
+        return len(self.epochSplits(self.epoch)[self.splits.index(self.split)])
+
+class BatchIndexSampler(udata.Sampler):
+    # yields one array of dataset indices per batch, so that RootDataset can gather the whole batch at once
+    def __init__(self, indices, batchSize, shuffle=False, generator=None):
+        self.indices = np.asarray(indices)
+        self.batchSize = batchSize
+        self.shuffle = shuffle
+        self.generator = generator
+
+    def setIndices(self, indices):
+        # the sampler is iterated in the main process, so a persistent DataLoader can be reused for every epoch
+        self.indices = np.asarray(indices)
+
+    def __iter__(self):
+        order = self.indices
+        if self.shuffle:
+            order = order[torch.randperm(len(order), generator=self.generator).numpy()]
+        for start in range(0, len(order), self.batchSize):
+            yield order[start:start+self.batchSize]
+
+    def __len__(self):
+        return (len(self.indices) + self.batchSize - 1) // self.batchSize
+
+class BucketBatchSampler(BatchIndexSampler):
+    # BatchIndexSampler grouping jets of similar numbers of constituents (sizes, for every dataset index) into batches
+    def __init__(self, indices, batchSize, sizes, shuffle=False, generator=None, poolBatches=50):
+        super().__init__(indices, batchSize, shuffle, generator)
+        self.sizes = sizes
+        self.poolBatches = poolBatches
+
+    def __iter__(self):
+        for batch in bucketBatches(self.sizes[self.indices], self.batchSize, self.shuffle, self.generator, self.poolBatches):
+            yield self.indices[batch]
+
+def getLoaderOptions(numWorkers=0, persistentWorkers=False, prefetchFactor=2, pinMemory=False):
+    # DataLoader keyword arguments; persistent_workers and prefetch_factor are only accepted with worker processes
+    options = {"num_workers": numWorkers, "pin_memory": pinMemory}
+    if numWorkers > 0:
+        options["persistent_workers"] = persistentWorkers
+        options["prefetch_factor"] = prefetchFactor
+    return options
+
+def getBatchLoader(dataset, indices, batchSize, shuffle=False, generator=None, sizes=None, **kwargs):
+    # batch_size=None turns off the per-item collation: each sampled index array is passed to dataset[...] as is.
+    # With the numbers of constituents of the jets (sizes), the batches are bucketed by them (see RootDataset.setTrimming)
+    if sizes is not None:
+        sampler = BucketBatchSampler(indices, batchSize, sizes, shuffle=shuffle, generator=generator)
+    else:
+        sampler = BatchIndexSampler(indices, batchSize, shuffle=shuffle, generator=generator)
+    return udata.DataLoader(dataset=dataset, sampler=sampler, batch_size=None, **kwargs)
+
+def collectLoader(loader, maxItems=None):
+    # concatenates the batches of a loader (at most maxItems items), e.g. to keep a streamed validation set in memory
+    batches = []
+    numItems = 0
+    for batch in loader:
+        batches.append(batch)
+        numItems += len(batch[0])
+        if maxItems is not None and numItems >= maxItems:
+            break
+    return [torch.cat(fields)[:maxItems] for fields in zip(*batches)]
+
+class TensorBatchLoader:
+    # alternative to getBatchLoader for the small, fixed subset of an epoch: its items are gathered once into
+    # contiguous tensors, kept on the device (resident=True) or in pinned host memory, and batches are slices
+    # of them in a shuffled order, so there is no DataLoader, sampler or collation in the training loop
+    def __init__(self, dataset, indices, batchSize, shuffle=False, generator=None, device=None, resident=False, tensors=None, minLength=None):
+        # tensors: items gathered already (e.g. with collectLoader), instead of dataset and indices.
+        # With minLength, jets of similar numbers of constituents are batched together and each batch is cut
+        # to its longest jet, but to at least minLength constituents
+        self.batchSize = batchSize
+        self.minLength = minLength
+        self.shuffle = shuffle
+        self.generator = generator
+        self.device = device if device is not None else torch.device("cpu")
+        self.resident = resident or self.device.type == "cpu"
+        if tensors is None:
+            tensors = dataset[np.asarray(indices)]
+        if self.resident:
+            self.tensors = [t.to(self.device) for t in tensors]
+        else:
+            self.tensors = [t.pin_memory() for t in tensors]
+        self.numItems = len(self.tensors[0])
+        if minLength is not None:
+            # real constituents come first, padded ones have all their features zero
+            self.sizes = (tensors[2] != 0).any(dim=1).sum(dim=-1).cpu().numpy()
+
+    def __len__(self):
+        return (self.numItems + self.batchSize - 1) // self.batchSize
+
+    def __iter__(self):
+        tensors = self.tensors
+        order = None
+        ends = list(range(self.batchSize, self.numItems, self.batchSize)) + [self.numItems]
+        lengths = None
+        if self.minLength is not None:
+            batches = bucketBatches(self.sizes, self.batchSize, self.shuffle, self.generator)
+            order = torch.from_numpy(np.concatenate(batches)) if batches else torch.arange(0)
+            # the short batch of the last pool can be anywhere in a shuffled order
+            ends = np.cumsum([len(b) for b in batches])
+            lengths = [int(np.clip(self.sizes[b].max(), self.minLength, tensors[1].shape[-1])) for b in batches]
+        elif self.shuffle:
+            order = torch.randperm(self.numItems, generator=self.generator)
+        if order is not None:
+            # one gather per epoch; the batches are then contiguous slices, which stay pinned in host memory
+            if self.resident:
+                tensors = [t[order.to(t.device)] for t in tensors]
+            else:
+                tensors = [t[order].pin_memory() for t in tensors]
+        starts = [0] + list(ends[:-1])
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            batch = tuple(t[start:end] for t in tensors)
+            if lengths is not None:
+                batch = trimBatch(batch, lengths[i])
+            if not self.resident:
+                batch = tuple(t.to(self.device, non_blocking=True) for t in batch)
+            yield batch
+
 class RootDataset(udata.Dataset):
-    def __init__(self, inputFolder, root_file, variables, pTBins, uniform, mT, weight, numConst):
-        inputPoints, inputFeatures, signal, mcType, pTLab, pTs, mTs, weights, mMeds, mDarks, rinvs, alphas, dfmean, dfstd, inputFileIndex, signalFileIndex = get_all_vars(inputFolder, root_file, variables, pTBins, uniform, mT, weight, numConst)
+    def __init__(self, inputFolder, root_file, variables, pTBins, uniform, mT, weight, numConst, cacheDir=None, memmap=False, readWorkers=None, maxConstituents=maxConstituentsPerFile, maxJets=None, jagged=False, float16=False, normStats=None, knnK=None):
+        if memmap and cacheDir is None:
+            raise ValueError("The memory-mapped dataset backend needs a cache directory (dataset.cache)")
+        # the jagged store keeps every constituent once plus per-jet offsets and pads the jets when they are fetched
+        fields = cacheFields + (jaggedFields if jagged else paddedFields)
+        # with knnK, the first-layer neighbours of each jet are computed here and stored with the points
+        if knnK is not None:
+            fields = fields + ["knnIdx"]
+        cachePath = None
+        if cacheDir is not None:
+            cachePath = os.path.join(cacheDir, getCacheKey(inputFolder, root_file, variables, pTBins, uniform, mT, weight, numConst, maxConstituents, maxJets, jagged, float16, normStats, knnK))
+            if normStats is not None and not os.path.isdir(cachePath):
+                # the statistics saved with a model are those its training computed from the data, and the training
+                # cache is keyed without them: evaluating on the training sample reuses that cache
+                ownPath = os.path.join(cacheDir, getCacheKey(inputFolder, root_file, variables, pTBins, uniform, mT, weight, numConst, maxConstituents, maxJets, jagged, float16, None, knnK))
+                if os.path.isdir(ownPath) and hasNormStats(ownPath, normStats):
+                    cachePath = ownPath
+        if cachePath is not None and os.path.isdir(cachePath):
+            arrays = loadCache(cachePath, fields, memmap)
+        else:
+            constPoints, constFeatures, jetOffsets, signal, mcType, pTLab, pTs, mTs, weights, mMeds, mDarks, rinvs, alphas, normStats, inputFileIndex, signalFileIndex = get_all_vars(inputFolder, root_file, variables, pTBins, uniform, mT, weight, numConst, readWorkers=readWorkers, maxConstituents=maxConstituents, maxJets=maxJets, normStats=normStats)
+            # compact storage: float32 (or float16) inputs and physics quantities, uint8 labels and categories,
+            # int16 pT bins; per-jet scalars are (N,1) columns, so that every field of an item or a slice of items
+            # is a view into these arrays. Consumers convert to the type they need (e.g. .long() for the loss)
+            floatType = np.float16 if float16 else np.float32
+            constPoints = constPoints.astype(floatType, copy=False)
+            constFeatures = constFeatures.astype(floatType, copy=False)
+            arrays = {
+                "signal": signal.reshape(-1,1),
+                "mcType": mcType.reshape(-1,1),
+                "pTLab": pTLab.reshape(-1,1),
+                "pTs": pTs.reshape(-1,1),
+                "mTs": mTs.reshape(-1,1),
+                "weights": weights.reshape(-1,1),
+                "mMeds": mMeds.reshape(-1,1),
+                "mDarks": mDarks.reshape(-1,1),
+                "rinvs": rinvs.reshape(-1,1),
+                "alphas": alphas.reshape(-1,1),
+                "normNames": np.array(normStats["names"]),
+                "normCount": np.array(normStats["count"]),
+                "normMean": normStats["mean"],
+                "normM2": normStats["m2"],
+                "inputFileIndex": inputFileIndex,
+                "signalFileIndex": np.array(signalFileIndex, dtype=np.int16),
+                "jetSizes": np.diff(jetOffsets).astype(np.int32),
+            }
+            if jagged:
+                arrays["constPoints"] = constPoints
+                arrays["constFeatures"] = constFeatures
+                arrays["jetOffsets"] = jetOffsets
+            else:
+                arrays["points"] = padJets(constPoints, jetOffsets, numConst)
+                arrays["features"] = padJets(constFeatures, jetOffsets, numConst)
+            if knnK is not None:
+                print("Computing the first-layer kNN graph")
+                arrays["knnIdx"] = getKnnIndices(constPoints, constFeatures, jetOffsets, numConst, knnK)
+            del constPoints, constFeatures
+            if cachePath is not None:
+                saveCache(cachePath, arrays)
+                if memmap:
+                    del arrays
+                    arrays = loadCache(cachePath, fields, memmap)
         self.root_file = root_file
         self.variables = variables
         self.uniform = uniform
         self.weight = weight
+        self.numConst = numConst
+        self.jagged = jagged
+        self.knnK = knnK
+        self.minLength = None
+        self.cachePath = cachePath
+        self.memmap = memmap
+        self.fields = fields
         # self.vars = dataSet.astype(float).values
-        self.points = inputPoints
-        self.features = inputFeatures
-        self.signal = signal
-        self.mcType = mcType
-        self.pTLab = pTLab
-        self.pTs = pTs.astype(float).values
-        self.mTs = mTs.astype(float).values
-        self.weights = weights.astype(float).values
-        self.mMeds = mMeds
-        self.mDarks = mDarks
-        self.rinvs = rinvs
-        self.alphas = alphas
-        self.normMean = np.array(dfmean)
-        self.normstd = np.array(dfstd)
-        self.inputFileIndex = np.array(inputFileIndex)
-        self.signalFileIndex = np.array(signalFileIndex)
+        self.setArrays(arrays)
         print("Number of events:", len(self.signal))
 
+    def setArrays(self, arrays):
+        if self.jagged:
+            self.constPoints = arrays["constPoints"]
+            self.constFeatures = arrays["constFeatures"]
+            self.jetOffsets = arrays["jetOffsets"]
+        else:
+            self.points = arrays["points"]
+            self.features = arrays["features"]
+        self.knnIdx = arrays.get("knnIdx")
+        self.signal = arrays["signal"]
+        self.mcType = arrays["mcType"]
+        self.pTLab = arrays["pTLab"]
+        self.pTs = arrays["pTs"]
+        self.mTs = arrays["mTs"]
+        self.weights = arrays["weights"]
+        self.mMeds = arrays["mMeds"]
+        self.mDarks = arrays["mDarks"]
+        self.rinvs = arrays["rinvs"]
+        self.alphas = arrays["alphas"]
+        self.normStats = {"names": arrays["normNames"], "count": int(arrays["normCount"]), "mean": arrays["normMean"], "m2": arrays["normM2"]}
+        self.normMean = self.normStats["mean"]
+        self.normstd = getNormStd(self.normStats)
+        self.inputFileIndex = arrays["inputFileIndex"]
+        self.signalFileIndex = arrays["signalFileIndex"]
+        self.jetSizes = arrays["jetSizes"]
+
+    def __getstate__(self):
+        # DataLoader workers started with spawn get a pickled copy of the dataset: a memory-mapped dataset
+        # is sent without its arrays and each worker maps the cache again, sharing the page cache.
+        # (With fork, the default on Linux, the workers share the parent's memory either way.)
+        state = self.__dict__.copy()
+        if self.memmap:
+            for name in self.fields + ["normStats","normMean","normstd"]:
+                state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.memmap:
+            self.setArrays(loadCache(self.cachePath, self.fields, True))
+
     #def get_arrays(self):
     #    return np.array(self.signal), torch.from_numpy(self.vars.astype(float).values.copy()).float().squeeze(1)
 
     def __len__(self):
-        return len(self.points)
+        return len(self.signal)
+
+    def withNumConst(self, numConst):
+        # the same jets padded to another number of constituents, sharing the arrays of the jagged store
+        if numConst == self.numConst:
+            return self
+        if not self.jagged:
+            raise ValueError("Changing numConst of a loaded dataset needs the jagged store (dataset.jagged)")
+        if self.knnK is not None:
+            raise ValueError("The precomputed kNN graph was built for numConst={}".format(self.numConst))
+        dataset = copy.copy(self)
+        dataset.numConst = numConst
+        return dataset
+
+    def getJetSizes(self, idx=slice(None)):
+        # numbers of (kept) constituents of the jets
+        return np.minimum(self.jetSizes[idx], self.numConst)
+
+    def setTrimming(self, minLength):
+        # batches fetched with an array of indices are cut to their longest jet, but to at least minLength constituents
+        # (e.g. k+1 for the kNN), instead of being padded to numConst; None turns it off. Best with bucketed
+        # batches of jets of similar sizes (BucketBatchSampler)
+        self.minLength = minLength
+
+    def getPadded(self, idx, length):
+        # pad the constituents of the requested jets from the jagged store
+        jets = np.arange(len(self))[idx]
+        points = padJets(self.constPoints, self.jetOffsets, length, np.atleast_1d(jets))
+        features = padJets(self.constFeatures, self.jetOffsets, length, np.atleast_1d(jets))
+        if np.ndim(jets) == 0:
+            return points[0], features[0]
+        return points, features
 
     def __getitem__(self, idx):
-        points_np = self.points[idx].copy()
-        features_np = self.features[idx].copy()
-        label_np = np.zeros(1, dtype=np.long).copy()
-        mcType_np = np.array([np.long(self.mcType[idx])]).copy()
-        pTLab_np = np.array([np.long(self.pTLab[idx])]).copy()
-        pTs_np = self.pTs[idx].copy()
-        mTs_np = self.mTs[idx].copy()
-        weights_np = self.weights[idx].copy()
-        mMeds_np = np.array([self.mMeds[idx]]).copy()
-        mDarks_np = np.array([self.mDarks[idx]]).copy()
-        rinvs_np = np.array([self.rinvs[idx]]).copy()
-        alphas_np = np.array([np.long(self.alphas[idx])]).copy()
-
-        if self.signal[idx][1]:
-            label_np += 1
-
-        points  = torch.from_numpy(points_np)
-        features  = torch.from_numpy(features_np)
-        # print("Data inside getitem")
-        # print(data)
-        label = torch.from_numpy(label_np)
-        mcType = torch.from_numpy(mcType_np)
-        pTLab = torch.from_numpy(pTLab_np)
-        pTs = torch.from_numpy(pTs_np).float()
-        mTs = torch.from_numpy(mTs_np).float()
-        weights = torch.from_numpy(weights_np).float()
-        mMeds = torch.from_numpy(mMeds_np).float()
-        mDarks = torch.from_numpy(mDarks_np).float()
-        rinvs = torch.from_numpy(rinvs_np).float()
-        alphas = torch.from_numpy(alphas_np)
-        return label, points, features, mcType, pTLab, pTs, mTs, weights, mMeds, mDarks, rinvs, alphas
+        # idx is an integer or a slice, for which every field is a view into the stored
+        # (possibly memory-mapped) arrays and torch.from_numpy does not copy it,
+        # or an array of indices, for which the whole batch is gathered with one fancy-index per field;
+        # with the jagged store the points and features are padded here instead.
+        # knnIdx holds the precomputed first-layer neighbours, or nothing (size 0) without them
+        if isinstance(idx, (list, np.ndarray, torch.Tensor)):
+            idx = np.asarray(idx)
+        length = self.numConst
+        if self.minLength is not None and isinstance(idx, np.ndarray) and len(idx) > 0:
+            length = int(np.clip(self.getJetSizes(idx).max(), self.minLength, self.numConst))
+        label = torch.from_numpy(self.signal[idx])
+        if self.jagged:
+            points, features = self.getPadded(idx, length)
+            points = torch.from_numpy(points)
+            features = torch.from_numpy(features)
+        elif length < self.numConst:
+            points = torch.from_numpy(self.points[idx, :, :length])
+            features = torch.from_numpy(self.features[idx, :, :length])
+        else:
+            points = torch.from_numpy(self.points[idx])
+            features = torch.from_numpy(self.features[idx])
+        mcType = torch.from_numpy(self.mcType[idx])
+        pTLab = torch.from_numpy(self.pTLab[idx])
+        pTs = torch.from_numpy(self.pTs[idx])
+        mTs = torch.from_numpy(self.mTs[idx])
+        weights = torch.from_numpy(self.weights[idx])
+        mMeds = torch.from_numpy(self.mMeds[idx])
+        mDarks = torch.from_numpy(self.mDarks[idx])
+        rinvs = torch.from_numpy(self.rinvs[idx])
+        alphas = torch.from_numpy(self.alphas[idx])
+        if self.knnIdx is not None and length < self.numConst:
+            knnIdx = trimKnn(torch.from_numpy(self.knnIdx[idx, :length]), length)
+        elif self.knnIdx is not None:
+            knnIdx = torch.from_numpy(self.knnIdx[idx])
+        else:
+            knnIdx = torch.empty(label.shape[:-1] + (0,), dtype=torch.uint8)
+        return label, points, features, mcType, pTLab, pTs, mTs, weights, mMeds, mDarks, rinvs, alphas, knnIdx
+
+def getRootDataset(args, normStats=None, precomputeKnn=True):
+    # the RootDataset of a config (dataset, features and hyper sections); precomputeKnn=False skips the neighbours
+    # of dataset.precompute_knn, for models that compute them themselves (e.g. an exported one)
+    dSet = args.dataset
+    hyper = args.hyper
+    inputFiles = dict(dSet.background)
+    inputFiles.update(dSet.signal)
+    knnK = hyper.num_of_k_nearest if dSet.precompute_knn and precomputeKnn else None
+    return RootDataset(inputFolder=dSet.path, root_file=inputFiles, variables=args.features.train, pTBins=hyper.pTBins, uniform=args.features.uniform, mT=args.features.mT, weight=args.features.weight, numConst=hyper.numConst, cacheDir=dSet.cache, memmap=dSet.memmap, readWorkers=dSet.read_workers, maxConstituents=dSet.max_constituents, maxJets=dSet.max_jets, jagged=dSet.jagged, float16=dSet.float16, normStats=normStats, knnK=knnK)
+
+def getSplitIndex(fileIndex, evtNum, frac):
+    # deterministic train/val/test assignment from a hash of (file, event), so that every
+    # jet of an event ends up in the same subset whichever order the files are read in
+    h = np.asarray(evtNum).astype(np.int64).astype(np.uint64) * np.uint64(2654435761) + np.uint64(fileIndex) * np.uint64(40503)
+    u = (h % np.uint64(2**32)).astype(np.float64) / 2**32
+    return np.searchsorted(np.cumsum(frac) / np.sum(frac), u, side="right")
+
+def getStreamNormStats(inputFolder, samples, variables, uniform, mT, weight, tree="tree"):
+    # one pass over the files merging the statistics of each chunk, so the memory use does not grow with the sample
+    keys, fileNames, _ = listInputFiles(samples)
+    columns = getNormColumns(variables)
+    statsList = []
+    for key, fileName in zip(keys, fileNames):
+        for branches in iterateFile(inputFolder, key, fileName, variables, uniform, mT, weight, tree):
+            statsList.append(getNormStats(branches, columns))
+    return mergeNormStats(statsList)
+
+def shuffleBuffer(items, bufferSize, rng):
+    # approximate shuffle of a stream: each new item takes the place of a random one in a fixed-size buffer
+    if bufferSize <= 1:
+        yield from items
+        return
+    buffer = []
+    for item in items:
+        if len(buffer) < bufferSize:
+            buffer.append(item)
+            continue
+        i = rng.randint(bufferSize)
+        yield buffer[i]
+        buffer[i] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+class StreamingRootDataset(udata.IterableDataset):
+    # out-of-core alternative to RootDataset for samples that do not fit in memory: the ROOT files are read
+    # chunk by chunk while iterating and only a shuffle buffer of jets is kept. Items are the same as RootDataset[i].
+    # balanced=True draws jetsPerEpoch jets, half signal and half background, cycling through the files as needed;
+    # balanced=False goes once through every jet of the split (for validation and testing)
+    splits = ["train","val","test"]
+    fields = ["signal","points","features","mcType","pTLab","pTs","mTs","weights","mMeds","mDarks","rinvs","alphas","knnIdx"]
+
+    def __init__(self, inputFolder, root_file, variables, pTBins, uniform, mT, weight, numConst, split="train", sampleFractions=[0.8,0.1,0.1], balanced=True, jetsPerEpoch=None, shuffleBuffer=10000, float16=False, normStats=None, seed=2022, rank=0, worldSize=1, tree="tree", knnK=None):
+        if balanced and jetsPerEpoch is None:
+            raise ValueError("Balanced streaming needs the number of jets per epoch (dataset.stream_jets_per_epoch)")
+        if split not in self.splits:
+            raise ValueError("Unknown split {}, expected one of {}".format(split, self.splits))
+        self.inputFolder = inputFolder
+        self.root_file = root_file
+        self.variables = variables
+        self.pTBins = pTBins
+        self.uniform = uniform
+        self.mT = mT
+        self.weight = weight
+        self.numConst = numConst
+        self.knnK = knnK
+        self.split = split
+        self.sampleFractions = sampleFractions
+        self.balanced = balanced
+        self.jetsPerEpoch = jetsPerEpoch
+        self.shuffleBuffer = shuffleBuffer
+        self.floatType = np.float16 if float16 else np.float32
+        self.seed = seed
+        self.rank = rank
+        self.worldSize = worldSize
+        self.tree = tree
+        self.keys, self.fileNames, self.signalFileIndex = listInputFiles(root_file)
+        if normStats is None:
+            normStats = getStreamNormStats(inputFolder, root_file, variables, uniform, mT, weight, tree)
+        self.normStats = normStats
+        self.normMean = normStats["mean"]
+        self.normstd = getNormStd(normStats)
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        # the jets drawn and their order depend on the epoch, the same way for every worker and rank
+        self.epoch = epoch
+
+    def __len__(self):
+        if not self.balanced:
+            raise TypeError("The number of jets of an unbalanced StreamingRootDataset is only known after reading it")
+        return self.jetsPerEpoch // self.worldSize
+
+    def getShard(self):
+        workerInfo = udata.get_worker_info()
+        numWorkers, workerId = (1, 0) if workerInfo is None else (workerInfo.num_workers, workerInfo.id)
+        return self.rank * numWorkers + workerId, self.worldSize * numWorkers
+
+    def assignFiles(self, shard, numShards):
+        # a shard reads whole files when a class has enough of them, otherwise every numShards-th jet of each file;
+        # returns (fileIndex, stride, offset) for each file the shard reads
+        assigned = []
+        for isSignal in [False, True]:
+            files = [i for i in range(len(self.fileNames)) if (i in self.signalFileIndex) == isSignal]
+            if len(files) >= numShards:
+                assigned += [(i, 1, 0) for i in files[shard::numShards]]
+            else:
+                assigned += [(i, numShards, shard) for i in files]
+        return assigned
+
+    def jetTables(self, fileIndex):
+        # yields tables of complete jets: a jet can straddle two chunks, so the last jet of each chunk waits for the next one
+        carry = None
+        for branches in iterateFile(self.inputFolder, self.keys[fileIndex], self.fileNames[fileIndex], self.variables, self.uniform, self.mT, self.weight, self.tree):
+            if carry is not None:
+                branches = pd.concat([carry, branches])
+            lastStart = np.flatnonzero(jetStarts(branches["jCstEvtNum"].to_numpy(), branches["jCstJNum"].to_numpy()))[-1]
+            carry = branches.iloc[lastStart:]
+            if lastStart > 0:
+                yield branches.iloc[:lastStart]
+        if carry is not None:
+            yield carry
+
+    def iterateJets(self, fileIndex, stride=1, offset=0):
+        # yields the jets of one file that belong to this split, one at a time
+        key = self.keys[fileIndex]
+        fileName = self.fileNames[fileIndex]
+        numSeen = 0
+        for branches in self.jetTables(fileIndex):
+            branches, spectators, jetSizes = processConstituents(branches, key, fileName, fileIndex, self.variables, self.pTBins, self.uniform, self.mT, self.weight)
+            jetOffsets = np.concatenate([[0], np.cumsum(jetSizes)])
+            evtNum = branches["jCstEvtNum"].to_numpy()[jetOffsets[:-1]]
+            keep = getSplitIndex(fileIndex, evtNum, self.sampleFractions) == self.splits.index(self.split)
+            keep &= (numSeen + np.arange(len(keep))) % stride == offset
+            numSeen += len(keep)
+            if not keep.any():
+                continue
+            branches = branches.assign(jCstEta_Norm=branches["jCstEta"], jCstPhi_Norm=branches["jCstPhi"])
+            constPoints, constFeatures, signal, _ = getParticleNetInputs(branches, jetOffsets, self.signalFileIndex, self.normStats)
+            constPoints = constPoints.astype(self.floatType, copy=False)
+            constFeatures = constFeatures.astype(self.floatType, copy=False)
+            jets = np.flatnonzero(keep)
+            arrays = {
+                "signal": signal[jets].reshape(-1,1),
+                "points": padJets(constPoints, jetOffsets, self.numConst, jets),
+                "features": padJets(constFeatures, jetOffsets, self.numConst, jets),
+                "mcType": spectators["mcType"][jets].reshape(-1,1),
+                "pTLab": spectators["pTLab"][jets].reshape(-1,1),
+                "pTs": spectators["pT"][jets].reshape(-1,1),
+                "mTs": spectators["mT"][jets].reshape(-1,1),
+                "weights": spectators["weight"][jets].reshape(-1,1),
+                "mMeds": spectators["mMed"][jets].reshape(-1,1),
+                "mDarks": spectators["mDark"][jets].reshape(-1,1),
+                "rinvs": spectators["rinv"][jets].reshape(-1,1),
+                "alphas": spectators["alpha"][jets].reshape(-1,1),
+                "knnIdx": getKnnIndices(constPoints, constFeatures, jetOffsets, self.numConst, self.knnK, jets) if self.knnK is not None else np.empty((len(jets),0), dtype=np.uint8),
+            }
+            # copies, so that the jets waiting in the shuffle buffer do not keep whole chunks alive
+            for i in range(len(jets)):
+                yield tuple(arrays[name][i].copy() for name in self.fields)
+
+    def balancedJets(self, assigned, numJets, rng):
+        # pick signal or background with equal probability, then one of the files of that class uniformly
+        classes = [[f for f in assigned if (f[0] in self.signalFileIndex) == isSignal] for isSignal in [False, True]]
+        classes = [files for files in classes if files]
+        iterators = {}
+        numDrawn = 0
+        while numDrawn < numJets and classes:
+            files = classes[rng.randint(len(classes))]
+            f = files[rng.randint(len(files))]
+            item = next(iterators[f], None) if f in iterators else None
+            if item is None:
+                # start the file (again) from the beginning
+                iterators[f] = self.iterateJets(*f)
+                item = next(iterators[f], None)
+                if item is None:
+                    # no jet of this split in the file
+                    files.remove(f)
+                    classes = [files for files in classes if files]
+                    continue
+            numDrawn += 1
+            yield item
+
+    def __iter__(self):
+        shard, numShards = self.getShard()
+        rng = np.random.RandomState([self.seed, self.epoch, shard])
+        assigned = self.assignFiles(shard, numShards)
+        if self.balanced:
+            # every rank draws the same number of jets, so that distributed processes run the same number of steps
+            numWorkers = numShards // self.worldSize
+            jetsPerRank = self.jetsPerEpoch // self.worldSize
+            numJets = jetsPerRank // numWorkers + int(shard % numWorkers < jetsPerRank % numWorkers)
+            jets = self.balancedJets(assigned, numJets, rng)
+        else:
+            jets = (item for f in assigned for item in self.iterateJets(*f))
+        for item in shuffleBuffer(jets, self.shuffleBuffer, rng):
+            yield tuple(torch.from_numpy(x) for x in item)
 
 if __name__=="__main__":
     # parse arguments
-    rng = np.random.RandomState(2022) # set seeds for numpy.random
     parser = ArgumentParser(config_options=MagiConfigOptions(strict = True, default="configs/C1.py"),formatter_class=ArgumentDefaultsRawHelpFormatter)
     parser.add_config_only(*c.config_schema)
     parser.add_config_only(**c.config_defaults)
@@ -324,20 +1005,17 @@ if __name__=="__main__":
     mTs = args.features.mT
     weights = args.features.weight
     numConst = args.hyper.numConst
-    dataset = RootDataset(dSet.path, inputFiles, varSet, pTBins, uniform, mTs, weights, numConst)
+    dataset = getRootDataset(args)
     print("Splitting dataset")
     # print(udata.Subset(dataset,np.arange(0,100)))
-    randBalancedSet = splitDataSetEvenly(dataset)
+    balancedSampler = BalancedEpochSampler(dataset.inputFileIndex, dataset.signalFileIndex, sampleFractions=dSet.sample_fractions)
     entireDataSet = dataset
-    print("randBalancedSet:")
-    for set in randBalancedSet:
-        print(set)
+    print("balanced epoch sets:")
+    for i in range(10):
+        print(balancedSampler.epochIndices(i))
     for i in range(10):
-        dataset = udata.Subset(entireDataSet,randBalancedSet[i])
-        sizes = get_sizes(len(dataset), dSet.sample_fractions)
-        train, val, test = udata.random_split(dataset, sizes, generator=torch.Generator().manual_seed(42))
-        loader = udata.DataLoader(dataset=train, batch_size=train.__len__(), num_workers=0)
-        l, po, fea, mct, pl, p, m, w, med, dark, rinv, alpha = next(iter(loader))
+        trainIndices, valIndices, testIndices = balancedSampler.epochSplits(i)
+        l, po, fea, mct, pl, p, m, w, med, dark, rinv, alpha, knnIdx = entireDataSet[trainIndices]
     labels = l.squeeze(1).numpy()
     mcType = mct.squeeze(1).numpy()
     pTLab = pl.squeeze(1).numpy()
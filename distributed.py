@@ -0,0 +1,47 @@
+import os
+import builtins
+import torch
+import torch.distributed as dist
+
+# helpers for DistributedDataParallel training. The processes are started by torchrun
+# (or torch.distributed.launch --use_env), which sets RANK, WORLD_SIZE and LOCAL_RANK, e.g.
+#   torchrun --nproc_per_node=8 train.py -C configs/C1.py
+#   torchrun --nnodes=4 --node_rank=$NODE --master_addr=$HOST --nproc_per_node=8 train.py -C configs/C1.py
+# Without these variables everything runs as a single process.
+
+def isDistributed():
+    return int(os.environ.get("WORLD_SIZE", "1")) > 1
+
+def initDistributed():
+    # returns (rank, worldSize, device); gloo on CPU, nccl when every process has a GPU
+    if not isDistributed():
+        return 0, 1, torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    localRank = int(os.environ.get("LOCAL_RANK", "0"))
+    if torch.cuda.is_available():
+        torch.cuda.set_device(localRank)
+        device = torch.device("cuda", localRank)
+        backend = "nccl"
+    else:
+        device = torch.device("cpu")
+        backend = "gloo"
+    dist.init_process_group(backend=backend)
+    return dist.get_rank(), dist.get_world_size(), device
+
+def isMainProcess():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+def cleanupDistributed():
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+# the print of the interpreter, wrapped by setupPrinting; kept here so that calling it again (e.g. for every
+# train.run of a sweep worker) replaces the wrapper instead of wrapping it once more
+builtinPrint = builtins.print
+
+def setupPrinting(isMain):
+    # only rank 0 prints, unless called as print(..., force=True)
+    def print(*args, **kwargs):
+        force = kwargs.pop("force", False)
+        if isMain or force:
+            builtinPrint(*args, **kwargs)
+    builtins.print = print
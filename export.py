@@ -0,0 +1,119 @@
+#!/bin/env python
+import inspect
+import torch
+import particlenet_pf
+from magiconfig import ArgumentParser, MagiConfigOptions, ArgumentDefaultsRawHelpFormatter
+from configs import configs as c
+from checkpoint import loadState, isCheckpoint
+from scoring import ONNXScorer
+
+# inference artifact of a trained tagger: the model with the softmax included, traced with TorchScript and frozen,
+# so that it runs without the python model code and for any number of jets and constituents, e.g.
+#   python export.py --outf logs -C logs/config_out.py
+# writes logs/net_traced.pt, to be used as
+#   model = torch.jit.load("logs/net_traced.pt"); probabilities = model(points, features)
+# with float32 points (N, 2, P) and features (N, F, P); the inputs are not modified.
+# With --format onnx it writes logs/net.onnx instead, with inputs "points" and "features" and output "probabilities"
+# of the same shapes, for ONNX Runtime (scoring.ONNXScorer, score.py --backend onnx)
+
+def getInputFeatureVars(args):
+    return [var for var in args.features.train if var not in ["jCsthvCategory","jCstEvtNum","jCstJNum"]]
+
+def buildModel(args, modelLocation=None, forInference=True):
+    # the architecture of the config, with the weights of modelLocation (net.pth or a checkpoint) if given
+    hyper = args.hyper
+    network_options = {}
+    network_options["num_of_k_nearest"] = hyper.num_of_k_nearest
+    network_options["num_of_edgeConv_dim"] = hyper.num_of_edgeConv_dim
+    network_options["num_of_edgeConv_convLayers"] = hyper.num_of_edgeConv_convLayers
+    network_options["num_of_fc_layers"] = hyper.num_of_fc_layers
+    network_options["num_of_fc_nodes"] = hyper.num_of_fc_nodes
+    network_options["fc_dropout"] = hyper.fc_dropout
+    network_options["lean_edgeconv"] = hyper.lean_edgeconv
+    network_options["for_inference"] = forInference
+    model = particlenet_pf.get_model(getInputFeatureVars(args), **network_options)
+    if modelLocation is not None:
+        state = loadState(modelLocation)
+        model.load_state_dict(state["model"] if isCheckpoint(state) else state)
+    return model.eval()
+
+def getExampleInputs(numFeatures, numJets, numConst, numReal=None):
+    # random jets with numReal real constituents followed by padding
+    numReal = numConst if numReal is None else numReal
+    points = torch.randn(numJets, 2, numConst)
+    features = torch.randn(numJets, numFeatures, numConst)
+    points[:, :, numReal:] = 0
+    features[:, :, numReal:] = 0
+    return points, features
+
+def traceModel(model, points, features):
+    # the forward pass has no data-dependent control flow, so the trace is valid for other batch and constituent
+    # sizes too; freezing folds the parameters and the batch normalizations into the graph
+    with torch.no_grad():
+        traced = torch.jit.trace(model.eval(), (points, features))
+    return torch.jit.freeze(traced)
+
+def compileModel(model):
+    # torch.compile where available (torch >= 2.0), the eager model otherwise
+    if hasattr(torch, "compile"):
+        return torch.compile(model, dynamic=True)
+    return model
+
+def exportONNX(model, points, features, fileName, opset=13):
+    # the number of jets N and of constituents P stay dynamic; knn's topk takes k from the graph, which needs opset >= 10
+    options = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # the TorchScript-based exporter, which handles the dynamic axes of the gathers
+        options["dynamo"] = False
+    with torch.no_grad():
+        torch.onnx.export(model.eval(), (points, features), fileName, input_names=["points", "features"], output_names=["probabilities"],
+            dynamic_axes={"points": {0: "N", 2: "P"}, "features": {0: "N", 2: "P"}, "probabilities": {0: "N"}}, opset_version=opset, **options)
+
+def checkExport(exported, model, numFeatures, shapes):
+    # largest difference from the eager model over (numJets, numConst, numReal) shapes;
+    # exported is called like the model and returns the probabilities as a tensor or a numpy array
+    maxDiff = 0.0
+    for numJets, numConst, numReal in shapes:
+        points, features = getExampleInputs(numFeatures, numJets, numConst, numReal)
+        with torch.no_grad():
+            maxDiff = max(maxDiff, (torch.as_tensor(exported(points, features)) - model(points, features)).abs().max().item())
+    return maxDiff
+
+def main():
+    parser = ArgumentParser(config_options=MagiConfigOptions(strict = True, default="logs/config_out.py"),formatter_class=ArgumentDefaultsRawHelpFormatter)
+    parser.add_argument("--outf", type=str, default="logs", help="Folder of the trained model")
+    parser.add_argument("--model", type=str, default="net.pth", help="Trained model in the output folder")
+    parser.add_argument("--output", type=str, default=None, help="Exported model, written to the output folder (default: net_traced.pt or net.onnx)")
+    parser.add_argument("--format", type=str, default="torchscript", choices=["torchscript", "onnx"], help="Export to TorchScript or to ONNX")
+    parser.add_argument("--opset", type=int, default=13, help="ONNX opset version for --format onnx")
+    parser.add_config_only(*c.config_schema)
+    parser.add_config_only(**c.config_defaults)
+    args = parser.parse_args()
+
+    modelLocation = "{}/{}".format(args.outf, args.model)
+    print("Loading model from " + modelLocation)
+    model = buildModel(args, modelLocation)
+    numFeatures = len(getInputFeatureVars(args))
+    numConst = args.hyper.numConst
+    example = getExampleInputs(numFeatures, 8, numConst, numConst // 2)
+    # other batch sizes and constituent numbers than the exported ones
+    shapes = [(1, numConst, numConst // 3), (100, numConst, numConst), (33, 2 * numConst, numConst)]
+    if args.format == "onnx":
+        outputLocation = "{}/{}".format(args.outf, args.output or "net.onnx")
+        exportONNX(model, *example, outputLocation, args.opset)
+        print("Saved the ONNX model to " + outputLocation)
+        try:
+            exported = ONNXScorer(outputLocation).probabilities
+        except ImportError:
+            print("onnxruntime is not installed, skipping the comparison with the eager model")
+            return
+        print("Largest difference from the eager model: {:.3g}".format(checkExport(exported, model, numFeatures, shapes)))
+        return
+    exported = traceModel(model, *example)
+    print("Largest difference from the eager model: {:.3g}".format(checkExport(exported, model, numFeatures, shapes)))
+    outputLocation = "{}/{}".format(args.outf, args.output or "net_traced.pt")
+    torch.jit.save(exported, outputLocation)
+    print("Saved the traced model to " + outputLocation)
+
+if __name__ == "__main__":
+    main()
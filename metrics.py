@@ -0,0 +1,70 @@
+import torch
+import torch.distributed as dist
+
+# metric accumulators that are updated on the device from every batch and only read out at the end of an epoch,
+# so that the training loop never waits for the device to report a number
+
+class RunningMean:
+    # weighted running mean of a (scalar tensor) quantity, e.g. a batch loss
+    def __init__(self, device=None):
+        self.total = torch.zeros((), dtype=torch.float64, device=device)
+        self.count = torch.zeros((), dtype=torch.float64, device=device)
+
+    def update(self, value, n=1):
+        self.total += value.detach().double() * n
+        self.count += n
+
+    def tensors(self):
+        return [self.total, self.count]
+
+    def compute(self):
+        return (self.total / self.count).item() if self.count.item() > 0 else float("nan")
+
+class BinnedROC:
+    # weighted histograms of the scores of signal and background in numBins bins of [0,1]. The ROC curve and AUC
+    # are computed from them once per epoch; pairs of jets falling in the same bin count half, so the AUC is
+    # within 1/numBins-sized ties of the exact value
+    def __init__(self, numBins=1000, device=None):
+        self.numBins = numBins
+        self.sig = torch.zeros(numBins, dtype=torch.float64, device=device)
+        self.bkg = torch.zeros(numBins, dtype=torch.float64, device=device)
+
+    def update(self, scores, labels, weights=None):
+        # scores in [0,1], labels 1 for signal and 0 for background; multiplying rather than masking by the label
+        # keeps the shapes static, so nothing here synchronizes with the device
+        scores = scores.detach().reshape(-1)
+        labels = labels.reshape(-1).to(scores.device, torch.float64)
+        weights = torch.ones_like(labels) if weights is None else weights.detach().reshape(-1).to(scores.device, torch.float64)
+        bins = (scores.double() * self.numBins).long().clamp_(0, self.numBins - 1)
+        self.sig.index_add_(0, bins, weights * labels)
+        self.bkg.index_add_(0, bins, weights * (1 - labels))
+
+    def tensors(self):
+        return [self.sig, self.bkg]
+
+    def roc(self):
+        # false and true positive rates for thresholds at the bin edges, from the highest score down
+        tpr = torch.cumsum(self.sig.flip(0), 0) / self.sig.sum()
+        fpr = torch.cumsum(self.bkg.flip(0), 0) / self.bkg.sum()
+        zero = torch.zeros(1, dtype=torch.float64, device=tpr.device)
+        return torch.cat([zero, fpr]).cpu().numpy(), torch.cat([zero, tpr]).cpu().numpy()
+
+    def compute(self):
+        # probability that a signal jet scores higher than a background jet
+        sigTotal = self.sig.sum()
+        bkgTotal = self.bkg.sum()
+        if sigTotal.item() == 0 or bkgTotal.item() == 0:
+            return float("nan")
+        bkgBelow = torch.cumsum(self.bkg, 0) - self.bkg
+        return ((self.sig * (bkgBelow + 0.5 * self.bkg)).sum() / (sigTotal * bkgTotal)).item()
+
+def syncMetrics(metrics):
+    # sums the accumulators of all the distributed processes, in place
+    if not dist.is_initialized():
+        return
+    for metric in metrics.values():
+        for tensor in metric.tensors():
+            dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+
+def computeMetrics(metrics):
+    return {name: metric.compute() for name, metric in metrics.items()}
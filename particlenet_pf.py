@@ -1,6 +1,6 @@
 import torch
 import torch.nn as nn
-from ParticleNet import ParticleNet, FeatureConv
+from ParticleNet import ParticleNet, FeatureConv, get_mask
 
 
 class ParticleNetTagger1Path(nn.Module):
@@ -15,6 +15,7 @@ class ParticleNetTagger1Path(nn.Module):
                  use_counts=True,
                  pf_input_dropout=None,
                  for_inference=False,
+                 lean_edgeconv=False,
                  **kwargs):
         super(ParticleNetTagger1Path, self).__init__(**kwargs)
         self.pf_input_dropout = nn.Dropout(pf_input_dropout) if pf_input_dropout else None
@@ -26,10 +27,13 @@ class ParticleNetTagger1Path(nn.Module):
                               use_fusion=use_fusion,
                               use_fts_bn=use_fts_bn,
                               use_counts=use_counts,
-                              for_inference=for_inference)
+                              for_inference=for_inference,
+                              lean_edgeconv=lean_edgeconv)
 
-    def forward(self, pf_points, pf_features):
-        return self.pn(pf_points, self.pf_conv(pf_features))
+    def forward(self, pf_points, pf_features, knn_idx=None):
+        # the padding is masked from the input features: after pf_conv padded constituents are no longer zero
+        mask = get_mask(pf_features)
+        return self.pn(pf_points, self.pf_conv(pf_features) * mask, mask, knn_idx)
 
 
 def get_model(inputFeatureVars,**kwargs):
@@ -62,7 +66,8 @@ def get_model(inputFeatureVars,**kwargs):
                                    use_fts_bn=kwargs.get('use_fts_bn', False),
                                    use_counts=kwargs.get('use_counts', True),
                                    pf_input_dropout=kwargs.get('pf_input_dropout', None),
-                                   for_inference=kwargs.get('for_inference', False)
+                                   for_inference=kwargs.get('for_inference', False),
+                                   lean_edgeconv=kwargs.get('lean_edgeconv', False)
                                    )
     # model_info = {
     #     'input_names':list(data_config.input_names),
@@ -0,0 +1,35 @@
+import contextlib
+import torch
+
+# mixed precision modes (training.precision):
+#   fp32: no autocast (the default)
+#   bf16: autocast to bfloat16, on CPU or GPU; same range as float32, so no loss scaling is needed
+#   fp16: autocast to float16, GPU only, with dynamic loss scaling so that small gradients do not underflow
+precisionTypes = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+def checkPrecision(precision, device):
+    if precision not in precisionTypes:
+        raise ValueError("Unknown precision {}, use one of {}".format(precision, ", ".join(precisionTypes)))
+    if precision == "fp16" and device.type != "cuda":
+        raise ValueError("fp16 autocast needs a GPU, use bf16 on CPU")
+    if precision == "bf16" and not hasattr(torch, "autocast"):
+        raise ValueError("bf16 autocast needs torch >= 1.10")
+
+def autocast(precision, device):
+    # usage: with autocast(args.training.precision, device): ...
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    if hasattr(torch, "autocast"):
+        return torch.autocast(device_type=device.type, dtype=precisionTypes[precision])
+    # torch 1.9 only has the CUDA float16 autocast
+    return torch.cuda.amp.autocast()
+
+def noAutocast(device):
+    # float32 region inside an autocast one, for numerically sensitive parts (distances, DisCo)
+    if hasattr(torch, "autocast"):
+        return torch.autocast(device_type=device.type, enabled=False)
+    return torch.cuda.amp.autocast(enabled=False)
+
+def getGradScaler(precision):
+    # a disabled scaler passes the loss and the optimizer step through unchanged
+    return torch.cuda.amp.GradScaler(enabled=precision == "fp16")
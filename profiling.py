@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import contextlib
+import torch
+
+try:
+    import GPUtil
+except ImportError:
+    GPUtil = None
+
+class StepProfiler:
+    # opt-in instrumentation of the training steps: every `every` steps, the time spent in each stage
+    # (data fetch, forward, loss, DisCo, backward, optimizer, ...) and the device memory and utilization
+    # are written as one JSON line to fileName. With every=0 (the default) every call returns immediately,
+    # so no device synchronization or nvidia-smi query is ever made on the default path.
+    def __init__(self, fileName=None, every=0, device=None):
+        self.every = every if fileName is not None else 0
+        self.device = device
+        self.active = False
+        self.lastEnd = None
+        self.record = None
+        self.nullStage = contextlib.nullcontext()
+        self.logFile = None
+        if self.every > 0:
+            self.logFile = open(fileName, "a")
+
+    def sync(self):
+        if self.device is not None and self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def step(self, epoch, step, phase="train"):
+        # call at the start of a step, right after its batch has been fetched
+        if self.every <= 0:
+            return
+        self.active = step % self.every == 0
+        if not self.active:
+            return
+        self.sync()
+        now = time.perf_counter()
+        self.record = {"phase": phase, "epoch": epoch, "step": step, "time": time.time(), "stages": {}}
+        if self.lastEnd is not None:
+            self.record["stages"]["data"] = now - self.lastEnd
+        self.stageStart = now
+
+    @contextlib.contextmanager
+    def timeStage(self, name):
+        self.sync()
+        start = time.perf_counter()
+        yield
+        self.sync()
+        self.record["stages"][name] = self.record["stages"].get(name, 0.0) + time.perf_counter() - start
+
+    def stage(self, name):
+        # usage: with profiler.stage("forward"): ...
+        if not self.active:
+            return self.nullStage
+        return self.timeStage(name)
+
+    def end(self):
+        # call at the end of a step; the time until the next call of step is the data fetch time
+        if self.every <= 0:
+            return
+        if self.active:
+            self.sync()
+            self.record["stages"]["total"] = time.perf_counter() - self.stageStart
+            self.record.update(self.sampleDevice())
+            self.logFile.write(json.dumps(self.record) + "\n")
+            self.logFile.flush()
+            self.active = False
+        self.lastEnd = time.perf_counter()
+
+    def sampleDevice(self):
+        sample = {}
+        if self.device is not None and self.device.type == "cuda":
+            sample["memory_allocated"] = torch.cuda.memory_allocated(self.device)
+            sample["max_memory_allocated"] = torch.cuda.max_memory_allocated(self.device)
+            sample["memory_reserved"] = torch.cuda.memory_reserved(self.device)
+            if GPUtil is not None:
+                # GPUtil numbers the devices as nvidia-smi does, which matches CUDA_DEVICE_ORDER=PCI_BUS_ID
+                gpus = GPUtil.getGPUs()
+                visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+                index = self.device.index if self.device.index is not None else torch.cuda.current_device()
+                if visible:
+                    index = int(visible.split(",")[index])
+                if index < len(gpus):
+                    sample["gpu_load"] = gpus[index].load
+                    sample["gpu_memory_used"] = gpus[index].memoryUsed
+        return sample
+
+    def close(self):
+        if self.logFile is not None:
+            self.logFile.close()
+            self.logFile = None
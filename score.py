@@ -0,0 +1,60 @@
+#!/bin/env python
+import os
+import numpy as np
+import torch
+from magiconfig import ArgumentParser, MagiConfigOptions, ArgumentDefaultsRawHelpFormatter
+from configs import configs as c
+from precision import checkPrecision
+from dataset import getRootDataset, splitIndices, getLoaderOptions, loadNormStats
+from export import buildModel
+from scoring import TorchScorer, ONNXScorer
+from validation import getNNOutput
+
+# batch scoring of the jets of a config with a trained tagger, through PyTorch or ONNX Runtime, e.g.
+#   python score.py --outf logs -C logs/config_out.py --backend onnx
+# writes logs/scores.npz with the signal probability ("score") of every jet and its labels and spectators
+
+def main():
+    parser = ArgumentParser(config_options=MagiConfigOptions(strict = True, default="logs/config_out.py"),formatter_class=ArgumentDefaultsRawHelpFormatter)
+    parser.add_argument("--outf", type=str, default="logs", help="Folder of the trained model")
+    parser.add_argument("--backend", type=str, default="torch", choices=["torch", "onnx"], help="Score with the PyTorch model or with the ONNX model (export.py --format onnx) through ONNX Runtime")
+    parser.add_argument("--model", type=str, default=None, help="Model in the output folder (default: net.pth or net.onnx)")
+    parser.add_argument("--split", type=str, default="all", choices=["all", "train", "val", "test"], help="Jets to score, with dataset.sample_fractions")
+    parser.add_argument("--threads", type=int, default=None, help="Number of CPU threads")
+    parser.add_argument("--output", type=str, default="scores.npz", help="Scores, written to the output folder")
+    parser.add_config_only(*c.config_schema)
+    parser.add_config_only(**c.config_defaults)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    modelLocation = "{}/{}".format(args.outf, args.model or ("net.onnx" if args.backend == "onnx" else "net.pth"))
+    print("Scoring with " + modelLocation)
+    if args.backend == "onnx":
+        scorer = ONNXScorer(modelLocation, args.threads)
+    else:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        checkPrecision(args.training.precision, device)
+        scorer = TorchScorer(buildModel(args, modelLocation).to(device), device, args.training.precision, probabilities=True)
+
+    dSet = args.dataset
+    normStats = None
+    normStatsFile = "{}/normMeanStd.npz".format(args.outf)
+    if os.path.isfile(normStatsFile):
+        print("Using normalization from " + normStatsFile)
+        normStats = loadNormStats(normStatsFile)
+    # ONNX Runtime computes the neighbours itself
+    dataset = getRootDataset(args, normStats, precomputeKnn=args.backend == "torch")
+    indices = np.arange(len(dataset))
+    if args.split != "all":
+        indices = dict(zip(["train", "val", "test"], splitIndices(indices, dSet.sample_fractions)))[args.split]
+    loaderOptions = getLoaderOptions(args.training.num_workers, args.training.persistent_workers, args.training.prefetch_factor, args.training.pin_memory)
+
+    names = ["label", "score", "mcType", "pTLab", "pT", "mT", "weight", "mMed", "mDark", "rinv", "alpha"]
+    outputs = getNNOutput(dataset, indices, scorer, **loaderOptions)
+    outputLocation = "{}/{}".format(args.outf, args.output)
+    np.savez(outputLocation, **dict(zip(names, outputs)))
+    print("Saved the scores of {} jets to {}".format(len(indices), outputLocation))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import torch
+from torch.nn import functional as f
+from precision import autocast
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+# scoring backends for getNNOutput and score.py: called with a batch of points, features (and precomputed
+# first-layer neighbours, if any), they return the signal probability of each jet as a numpy array
+
+class TorchScorer:
+    # the eager model (returning logits), or with probabilities=True a model with the softmax included,
+    # e.g. the traced model of export.py. The traced model only takes points and features and computes the
+    # first-layer neighbours itself, so precomputed ones are only passed to an eager model
+    def __init__(self, model, device=torch.device("cpu"), precision="fp32", probabilities=False):
+        self.model = model.eval()
+        self.device = device
+        self.precision = precision
+        self.probabilities = probabilities
+        self.useKnn = not isinstance(model, torch.jit.ScriptModule)
+
+    def __call__(self, points, features, knnIdx=None):
+        inputs = [points.float().to(self.device), features.float().to(self.device)]
+        if self.useKnn and knnIdx is not None and knnIdx.shape[-1] > 0:
+            inputs.append(knnIdx.long().to(self.device))
+        with torch.no_grad(), autocast(self.precision, self.device):
+            output = self.model(*inputs).float()
+        if not self.probabilities:
+            output = f.softmax(output, dim=1)
+        return output[:,1].cpu().numpy()
+
+class ONNXScorer:
+    # a model written by export.py --format onnx, run by ONNX Runtime on CPU; it computes the first-layer
+    # neighbours itself, so precomputed ones are ignored
+    def __init__(self, fileName, numThreads=None):
+        if onnxruntime is None:
+            raise ImportError("ONNX scoring needs onnxruntime (pip install onnxruntime)")
+        options = onnxruntime.SessionOptions()
+        if numThreads:
+            options.intra_op_num_threads = numThreads
+        self.session = onnxruntime.InferenceSession(fileName, options, providers=["CPUExecutionProvider"])
+
+    def probabilities(self, points, features):
+        # (N, 2) class probabilities, like the model of export.py
+        inputs = {"points": points.float().numpy(), "features": features.float().numpy()}
+        return self.session.run(None, inputs)[0]
+
+    def __call__(self, points, features, knnIdx=None):
+        return self.probabilities(points, features)[:,1]
@@ -0,0 +1,108 @@
+#!/bin/env python
+import os
+import ast
+import sys
+import copy
+import itertools
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+import torch
+import train
+from dataset import getRootDataset
+
+# hyperparameter sweep: the dataset is read once into the memory-mapped cache, and the trials run concurrently
+# in a process pool, each one mapping the same cache (shared through the page cache) and writing its own outdir, e.g.
+#   python sweep.py -C configs/C1.py --outf sweep --jobs 4 --set hyper.num_of_k_nearest=8,16 --set hyper.learning_rate=0.001,0.002
+# Every combination of the --set values is one trial: outf/trial_NNN/ holds its model, metrics.csv, train.log
+# and output.csv (its parameters and final metrics), and outf/summary.csv gathers the output.csv of all trials.
+
+# these change the dataset itself, which is shared by all the trials (hyper.numConst only changes the padding)
+datasetKeys = ["dataset", "features", "hyper.pTBins"]
+
+def parseSetting(setting):
+    # "section.key=value1,value2,..." with python literals, e.g. hyper.num_of_edgeConv_dim=[32,64],[64,128]
+    name, values = setting.split("=", 1)
+    values = ast.literal_eval(values)
+    if not isinstance(values, tuple):
+        values = (values,)
+    if any(name == key or name.startswith(key + ".") for key in datasetKeys):
+        raise ValueError("{} changes the dataset, which the trials of a sweep share".format(name))
+    return name, list(values)
+
+def getTrials(settings):
+    names = [name for name, _ in settings]
+    return [dict(zip(names, values)) for values in itertools.product(*[values for _, values in settings])]
+
+def initWorker(slots, gpus=None, numThreads=None):
+    # each worker of the pool takes one slot and keeps its GPU for every trial it runs: CUDA reads
+    # CUDA_VISIBLE_DEVICES only once, when the first trial of the worker initializes it.
+    # Runs after the import of train.py, which sets its default
+    slot = slots.get()
+    if gpus:
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(gpus[slot % len(gpus)])
+    if numThreads is not None:
+        torch.set_num_threads(numThreads)
+
+def runTrial(index, args, trial, dataset):
+    args = copy.deepcopy(args)
+    for name, value in trial.items():
+        section, key = name.split(".")
+        setattr(getattr(args, section), key, value)
+    args.outf = "{}/trial_{:03d}".format(args.outf, index)
+    os.makedirs(args.outf, exist_ok=True)
+    with open(args.outf + "/train.log", "w") as logFile, contextlib.redirect_stdout(logFile), contextlib.redirect_stderr(logFile):
+        result = train.run(args, train.getParser(), dataset.withNumConst(args.hyper.numConst))
+    output = dict([("trial", index)] + list(trial.items()) + list(result.items()))
+    pd.DataFrame([output]).to_csv(args.outf + "/output.csv", index=False)
+    return output
+
+def main():
+    parser = train.getParser()
+    parser.add_argument("--set", type=str, action="append", default=[], help="Swept parameter as section.key=value1,value2,... (python literals); repeat for a grid over several")
+    parser.add_argument("--jobs", type=int, default=2, help="Number of trials run at the same time")
+    parser.add_argument("--gpus", type=int, nargs="+", default=None, help="GPUs given to the workers in turn, each running its trials on one (default: the one train.py uses)")
+    args = parser.parse_args()
+
+    settings = [parseSetting(setting) for setting in args.set]
+    trials = getTrials(settings)
+    print("Running {} trials, {} at a time".format(len(trials), args.jobs))
+    dSet = args.dataset
+    if dSet.streaming:
+        raise ValueError("Sweeps share one loaded dataset and do not support dataset.streaming")
+    # the trials map the cache instead of receiving a copy of the arrays
+    if dSet.cache is None:
+        dSet.cache = args.outf + "/cache"
+    dSet.memmap = True
+    if any(name == "hyper.numConst" for name, _ in settings):
+        dSet.jagged = True
+    if dSet.precompute_knn and any(name in ["hyper.numConst", "hyper.num_of_k_nearest"] for name, _ in settings):
+        raise ValueError("The precomputed kNN graph (dataset.precompute_knn) is built for one numConst and num_of_k_nearest")
+    os.makedirs(args.outf, exist_ok=True)
+    dataset = getRootDataset(args)
+
+    # spawn rather than fork: the parent has already started torch and reader threads
+    numThreads = max(1, (os.cpu_count() or 1) // args.jobs)
+    outputs = []
+    context = multiprocessing.get_context("spawn")
+    slots = context.Queue()
+    for slot in range(args.jobs):
+        slots.put(slot)
+    with ProcessPoolExecutor(max_workers=args.jobs, mp_context=context, initializer=initWorker, initargs=(slots, args.gpus, numThreads)) as executor:
+        futures = {executor.submit(runTrial, index, args, trial, dataset): index for index, trial in enumerate(trials)}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                output = future.result()
+            except Exception as e:
+                print("Trial {} failed: {}".format(index, e), file=sys.stderr)
+                output = dict([("trial", index)] + list(trials[index].items()) + [("error", str(e))])
+            print("Finished trial {}: {}".format(index, output))
+            outputs.append(output)
+    summary = pd.DataFrame(outputs).sort_values("trial")
+    summary.to_csv(args.outf + "/summary.csv", index=False)
+    print(summary.to_string(index=False))
+
+if __name__ == "__main__":
+    main()
@@ -4,25 +4,30 @@ import torch.nn as nn
 from torch.autograd import Variable
 from torch.nn import functional as f
 # from torch.utils.tensorboard import SummaryWriter
-from torch.cuda.amp import autocast
 import torch.utils.data as udata
 import torch.optim as optim
 import os
+import contextlib
 import particlenet_pf
-from dataset import RootDataset, get_sizes, splitDataSetEvenly
+from dataset import getRootDataset, StreamingRootDataset, TensorBatchLoader, getBatchLoader, getLoaderOptions, BalancedEpochSampler, collectLoader, saveNormStats
 import matplotlib.pyplot as plt
 from magiconfig import ArgumentParser, MagiConfigOptions, ArgumentDefaultsRawHelpFormatter
 from configs import configs as c
 import numpy as np
-from sklearn.metrics import roc_curve, auc, precision_recall_curve, average_precision_score, roc_auc_score
 from tqdm import tqdm
 from Disco import distance_corr
 import copy
-from GPUtil import showUtilization as gpu_usage
+from profiling import StepProfiler
+from distributed import isDistributed, initDistributed, isMainProcess, cleanupDistributed, setupPrinting
+from metrics import RunningMean, BinnedROC, syncMetrics, computeMetrics
+from precision import checkPrecision, autocast, noAutocast, getGradScaler
+from checkpoint import AsyncCheckpointer, toCPU, loadState, isCheckpoint, getRNGState, setRNGState
 
 # ask Kevin how to create training root files for the NN
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
-os.environ["CUDA_VISIBLE_DEVICES"] = "0"
+if not isDistributed():
+    # under torchrun each process picks its GPU from LOCAL_RANK instead
+    os.environ["CUDA_VISIBLE_DEVICES"] = "0"
 os.environ["NCCL_DEBUG"] = "INFO"
 
 def init_weights(m):
@@ -30,24 +35,21 @@ def init_weights(m):
         torch.nn.init.xavier_uniform_(m.weight)
         m.bias.data.fill_(0.01)
 
-def processBatch(args, device, varSet, data, model, criterion, lambdas, epoch):
-    label, points, features, mcType, pTLab, pT, mT, w, med, dark, rinv, alpha = data
+def processBatch(args, device, varSet, data, model, criterion, lambdas, epoch, profiler):
+    label, points, features, mcType, pTLab, pT, mT, w, med, dark, rinv, alpha, knnIdx = data
     l1, l2, lgr, ldc = lambdas
-    print("\n Initial GPU Usage")
-    gpu_usage()
-    with autocast():
+    with autocast(args.training.precision, device):
         # inputPoints = torch.randn(len(label.squeeze(1)),2,100).to(device)
         # inputFeatures = torch.randn(len(label.squeeze(1)),15,100).to(device)
-        output = model(points.float().to(device), features.float().to(device))
-        batch_loss = criterion(output.to(device), label.squeeze(1).to(device)).to(device)
-    torch.cuda.empty_cache()
-    print("\n After emptying cache")
-    gpu_usage()
+        with profiler.stage("forward"):
+            output = model(points.float().to(device), features.float().to(device), knnIdx.long().to(device) if knnIdx.shape[-1] > 0 else None)
+        with profiler.stage("loss"):
+            batch_loss = criterion(output.to(device), label.squeeze(1).long().to(device)).to(device)
     pTVal = pTLab.squeeze(1)
     labVal = label.squeeze(1)
 
     # Added distance correlation calculation between tagger output and jet pT
-    outTag = f.softmax(output,dim=1)[:,1]
+    outTag = f.softmax(output.float(),dim=1)[:,1]
     normedweight = torch.ones_like(outTag)
     # disco signal parameter
     sgpVal = pT.squeeze(1).to(device)
@@ -55,26 +57,63 @@ def processBatch(args, device, varSet, data, model, criterion, lambdas, epoch):
     maskedoutTag = torch.masked_select(outTag, mask)
     maskedsgpVal = torch.masked_select(sgpVal, mask)
     maskedweight = torch.masked_select(normedweight, mask)
-    batch_loss_dc = distance_corr(maskedoutTag.to(device), maskedsgpVal.to(device), maskedweight.to(device), 1).to(device)
+    # in float32: the pairwise distance matrices lose too much precision in half precision
+    with profiler.stage("disco"), noAutocast(device):
+        batch_loss_dc = distance_corr(maskedoutTag.float().to(device), maskedsgpVal.float().to(device), maskedweight.float().to(device), 1).to(device)
     lambdaDC = ldc
-    auc = roc_auc_score(label.to("cpu").squeeze(1).numpy(), outTag.to("cpu").detach().numpy())
-    return l1*batch_loss, lambdaDC*batch_loss_dc, batch_loss_dc, auc
+    return l1*batch_loss, lambdaDC*batch_loss_dc, batch_loss_dc, outTag
 
-def main():
-    rng = np.random.RandomState(2022)
-    # parse arguments
+def makeMetrics(device):
+    # per-epoch accumulators of the batch losses and of the tagger scores
+    return {"tag": RunningMean(device), "dc": RunningMean(device), "dc_val": RunningMean(device), "total": RunningMean(device), "auc": BinnedROC(device=device)}
+
+def updateMetrics(metrics, device, label, loss_tag, loss_dc, dc_val, loss_total, outTag):
+    metrics["tag"].update(loss_tag)
+    metrics["dc"].update(loss_dc)
+    metrics["dc_val"].update(dc_val)
+    metrics["total"].update(loss_total)
+    metrics["auc"].update(outTag, label.squeeze(1).to(device))
+
+def withLast(iterable):
+    # yields (isLast, item), reading one item ahead: a streamed loader with workers ends each worker's share with
+    # a partial batch, so its length does not give the last batch
+    iterator = iter(iterable)
+    try:
+        item = next(iterator)
+    except StopIteration:
+        return
+    for nextItem in iterator:
+        yield False, item
+        item = nextItem
+    yield True, item
+
+def getParser():
     parser = ArgumentParser(config_options=MagiConfigOptions(strict = True, default="configs/C1.py"),formatter_class=ArgumentDefaultsRawHelpFormatter)
     parser.add_argument("--outf", type=str, default="logs", help='Name of folder to be used to store outputs')
-    parser.add_argument("--model", type=str, default=None, help="Existing model to continue training, if applicable")
+    parser.add_argument("--model", type=str, default=None, help="Existing model to continue training, if applicable: a full checkpoint (checkpoint.pth) resumes the run, bare weights (net.pth) only initialize the model")
+    parser.add_argument("--resume", action="store_true", help="Resume from checkpoint.pth in the output folder if it exists, e.g. when a preempted job is restarted")
     parser.add_config_only(*c.config_schema)
     parser.add_config_only(**c.config_defaults)
+    return parser
+
+def main():
+    # parse arguments
+    parser = getParser()
     args = parser.parse_args()
+    run(args, parser)
 
-    if not os.path.isdir(args.outf):
-        os.mkdir(args.outf)
-    # Choose cpu or gpu
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+def run(args, parser, entireDataSet=None):
+    # trains one model; a RootDataset that is already loaded (e.g. shared by the trials of sweep.py) can be passed in.
+    # Returns the metrics of the last epoch and the early stopping state
+    # Choose cpu or gpu; when started by torchrun, one process per device (or per CPU slot, with gloo)
+    rank, worldSize, device = initDistributed()
+    isMain = isMainProcess()
+    setupPrinting(isMain)
+    os.makedirs(args.outf, exist_ok=True)
+    if worldSize > 1:
+        print("Distributed training with {} processes".format(worldSize))
     print('Using device:', device)
+    checkPrecision(args.training.precision, device)
     if device.type == 'cuda':
         gpuIndex = torch.cuda.current_device()
         print("Using GPU named: \"{}\"".format(torch.cuda.get_device_name(gpuIndex)))
@@ -85,10 +124,9 @@ def main():
     # Load dataset
     print('Loading dataset ...')
     dSet = args.dataset
-    sigFiles = dSet.signal
-    inputFiles = dSet.background
     hyper = args.hyper
-    inputFiles.update(sigFiles)
+    # a copy, so that the config written to config_out.py keeps the signal samples under signal only
+    inputFiles = dict(dSet.background, **dSet.signal)
     print(inputFiles)
     varSet = args.features.train
     inputFeatureVars = [var for var in varSet if var not in ["jCsthvCategory","jCstEvtNum","jCstJNum"]]
@@ -98,8 +136,28 @@ def main():
     mT = args.features.mT
     weight = args.features.weight
     numConst = args.hyper.numConst
-    entireDataSet = RootDataset(inputFolder=dSet.path, root_file=inputFiles, variables=varSet, pTBins=pTBins, uniform=uniform, mT=mT, weight=weight, numConst=numConst)
-    randBalancedSet = splitDataSetEvenly(entireDataSet,rng,hyper.epochs)
+    # neighbours of the first EdgeConv block computed with the data instead of in every forward pass
+    knnK = hyper.num_of_k_nearest if dSet.precompute_knn else None
+    if dSet.streaming:
+        # out-of-core mode: the files are read while iterating; the validation set is streamed once and kept in memory
+        trainStream = StreamingRootDataset(inputFolder=dSet.path, root_file=inputFiles, variables=varSet, pTBins=pTBins, uniform=uniform, mT=mT, weight=weight, numConst=numConst, split="train", sampleFractions=dSet.sample_fractions, balanced=True, jetsPerEpoch=dSet.stream_jets_per_epoch, shuffleBuffer=dSet.shuffle_buffer, float16=dSet.float16, seed=hyper.rseed, rank=rank, worldSize=worldSize, knnK=knnK)
+        # with training.val_size, a class-balanced draw from the validation split (always that of epoch 0, since
+        # set_epoch is never called); without it, the whole validation split once. The files are read class by class,
+        # so cutting the unbalanced stream short would keep only background jets
+        valBalanced = args.training.val_size is not None
+        valStream = StreamingRootDataset(inputFolder=dSet.path, root_file=inputFiles, variables=varSet, pTBins=pTBins, uniform=uniform, mT=mT, weight=weight, numConst=numConst, split="val", sampleFractions=dSet.sample_fractions, balanced=valBalanced, jetsPerEpoch=args.training.val_size, shuffleBuffer=0, float16=dSet.float16, normStats=trainStream.normStats, rank=rank, worldSize=worldSize, knnK=knnK)
+        normStats = trainStream.normStats
+    else:
+        if entireDataSet is None:
+            entireDataSet = getRootDataset(args)
+        normStats = entireDataSet.normStats
+        # the balanced set of each epoch is drawn when the epoch starts; every process draws the same (same seed) and keeps its own share
+        balancedSampler = BalancedEpochSampler(entireDataSet.inputFileIndex, entireDataSet.signalFileIndex, seed=2022, sampleFractions=dSet.sample_fractions, rank=rank, worldSize=worldSize)
+        # one fixed validation subset (the validation split of the first epoch set), never trained on in any epoch
+        fixedValIndices = balancedSampler.holdOut(0, "val", args.training.val_size)
+    # the normalization used for training is stored next to the model and reused when evaluating it
+    if isMain:
+        saveNormStats(args.outf + "/normMeanStd.npz", normStats)
     # Build model
     network_module = particlenet_pf
     network_options = {}
@@ -109,17 +167,37 @@ def main():
     network_options["num_of_fc_layers"] = args.hyper.num_of_fc_layers
     network_options["num_of_fc_nodes"] = args.hyper.num_of_fc_nodes
     network_options["fc_dropout"] = args.hyper.fc_dropout
+    network_options["lean_edgeconv"] = args.hyper.lean_edgeconv
     model = network_module.get_model(inputFeatureVars,**network_options)
-    if (args.model == None):
+    checkpointLocation = "{}/checkpoint.pth".format(args.outf)
+    loadLocation = None
+    if args.resume and os.path.isfile(checkpointLocation):
+        loadLocation = checkpointLocation
+    elif args.model is not None:
+        loadLocation = args.model if os.path.isfile(args.model) else "{}/{}".format(args.outf,args.model)
+    resumeState = None
+    if loadLocation is None:
         #model.apply(init_weights)
         print("Creating new model ")
-        args.model = 'net.pth'
     else:
-        print("Loading model from " + modelLocation)
+        print("Loading model from " + loadLocation)
+        state = loadState(loadLocation)
+        if isCheckpoint(state):
+            resumeState = state
+            state = state["model"]
+        model.load_state_dict(state)
+    if args.model is None or resumeState is not None:
+        args.model = 'net.pth'
     model = copy.deepcopy(model)
     model = model.to(device)
     model.eval()
-    modelLocation = "{}/{}".format(args.outf,args.model)
+    modelLocation = "{}/{}".format(args.outf,os.path.basename(args.model))
+    trainModel = model
+    if worldSize > 1:
+        # SyncBatchNorm only runs on CUDA tensors: with gloo on CPU every process normalizes with its own batch
+        if device.type == "cuda":
+            model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
+        trainModel = nn.parallel.DistributedDataParallel(model, device_ids=[device.index] if device.type == "cuda" else None)
 
     # Loss function
     criterion = nn.CrossEntropyLoss()
@@ -128,6 +206,12 @@ def main():
     #Optimizer
     optimizer = optim.Adam(model.parameters(), lr = hyper.learning_rate)
     scheduler = optim.lr_scheduler.ExponentialLR(optimizer=optimizer, gamma=0.95, last_epoch=-1, verbose=True)
+    # loss scaling for fp16, a pass-through otherwise
+    scaler = getGradScaler(args.training.precision)
+    accumSteps = args.training.accum_steps
+
+    # sampled stage timings and device memory, off unless training.profile_every is set
+    profiler = StepProfiler(args.training.profile_file or args.outf + "/profile.jsonl", args.training.profile_every if isMain else 0, device)
 
     # training and validation
     # writer = SummaryWriter()
@@ -137,98 +221,187 @@ def main():
     validation_losses_tag = np.zeros(hyper.epochs)
     validation_losses_dc = np.zeros(hyper.epochs)
     validation_losses_total = np.zeros(hyper.epochs)
-    aucs = []
-    for epoch in range(hyper.epochs):
-        dataset = udata.Subset(entireDataSet,randBalancedSet[epoch])
-        sizes = get_sizes(len(dataset), dSet.sample_fractions)
-        train, val, test = udata.random_split(dataset, sizes, generator=torch.Generator().manual_seed(42))
-        loader_train = udata.DataLoader(dataset=train, batch_size=hyper.batchSize, num_workers=0, shuffle=True)
-        loader_val = udata.DataLoader(dataset=val, batch_size=hyper.batchSize, num_workers=0)
-        loader_test = udata.DataLoader(dataset=test, batch_size=hyper.batchSize, num_workers=0)
+    losses = {"training_tag": training_losses_tag, "training_dc": training_losses_dc, "training_total": training_losses_total, "validation_tag": validation_losses_tag, "validation_dc": validation_losses_dc, "validation_total": validation_losses_total}
+    startEpoch = 0
+    # best validation value (lower loss or higher AUC), its epoch and the number of checks since it improved
+    earlyStopping = {"best": None, "bestEpoch": None, "badChecks": 0}
+    bestLocation = "{}/net_best.pth".format(args.outf)
+    if resumeState is not None:
+        optimizer.load_state_dict(resumeState["optimizer"])
+        scheduler.load_state_dict(resumeState["scheduler"])
+        if "scaler" in resumeState:
+            scaler.load_state_dict(resumeState["scaler"])
+        for name, values in resumeState["losses"].items():
+            numEpochs = min(len(values), hyper.epochs)
+            losses[name][:numEpochs] = values[:numEpochs]
+        # the epoch sets are drawn from the seed and the epoch number, so the run continues with the next one
+        startEpoch = resumeState["epoch"] + 1
+        setRNGState(resumeState["rng"])
+        earlyStopping = resumeState.get("early_stopping", earlyStopping)
+        print("Resuming at epoch {}".format(startEpoch))
+        del resumeState
+    bestState = None
+    if args.training.early_stopping is not None and earlyStopping["best"] is not None and os.path.isfile(bestLocation):
+        bestState = loadState(bestLocation)
+    checkpointer = AsyncCheckpointer()
+    loaderOptions = getLoaderOptions(args.training.num_workers, args.training.persistent_workers, args.training.prefetch_factor, args.training.pin_memory)
+    # batches of jets with similar numbers of constituents, each cut to its longest jet (but at least k+1 for the kNN)
+    # instead of padded to numConst; not for the streamed training set, which is only shuffled in a buffer
+    minLength = hyper.num_of_k_nearest + 1 if args.training.bucketing else None
+    jetSizes = None
+    if not dSet.streaming and minLength is not None:
+        entireDataSet.setTrimming(minLength)
+        jetSizes = entireDataSet.getJetSizes()
+    if not dSet.streaming and args.training.epoch_storage is None:
+        # created once and given the indices of each epoch, so that persistent workers serve every epoch
+        loader_train = getBatchLoader(entireDataSet, [], hyper.batchSize, shuffle=True, sizes=jetSizes, **loaderOptions)
+    streamOptions = getLoaderOptions(args.training.num_workers, False, args.training.prefetch_factor, args.training.pin_memory)
+    # the validation subset is gathered once into tensors and scored from them at every check
+    valResident = args.training.epoch_storage == "device"
+    if dSet.streaming:
+        valTensors = collectLoader(udata.DataLoader(valStream, batch_size=hyper.batchSize, **streamOptions))
+        loader_val = TensorBatchLoader(None, None, hyper.batchSize, device=device, resident=valResident, tensors=valTensors, minLength=minLength)
+        del valTensors
+    else:
+        loader_val = TensorBatchLoader(entireDataSet, fixedValIndices, hyper.batchSize, device=device, resident=valResident, minLength=minLength)
+    stopped = False
+    summary = {}
+    for epoch in range(startEpoch, hyper.epochs):
+        if dSet.streaming:
+            trainStream.set_epoch(epoch)
+            # a new loader every epoch: persistent workers would keep iterating the dataset of the first epoch
+            loader_train = udata.DataLoader(trainStream, batch_size=hyper.batchSize, **streamOptions)
+        else:
+            trainIndices, valIndices, testIndices = balancedSampler.epochSplits(epoch)
+            if args.training.epoch_storage is not None:
+                # the epoch subsets are copied once into contiguous tensors ("host": pinned memory, "device": on the device)
+                resident = args.training.epoch_storage == "device"
+                loader_train = TensorBatchLoader(entireDataSet, trainIndices, hyper.batchSize, shuffle=True, device=device, resident=resident, minLength=minLength)
+            else:
+                loader_train.sampler.setIndices(trainIndices)
         print("Beginning epoch " + str(epoch))
         # training
-        train_loss_tag = 0
-        train_loss_dc = 0
-        train_dc_val = 0
-        train_loss_total = 0
-        for i, data in tqdm(enumerate(loader_train), unit="batch", total=len(loader_train)):
+        train_metrics = makeMetrics(device)
+        optimizer.zero_grad()
+        for i, (lastBatch, data) in tqdm(enumerate(withLast(loader_train)), unit="batch", total=len(loader_train), disable=not isMain):
             model.train()
-            model.zero_grad()
-            optimizer.zero_grad()
-            batch_loss_tag, batch_loss_dc, dc_val, auc_train = processBatch(args, device, varSet, data, model, criterion, [hyper.lambdaTag, hyper.lambdaReg, hyper.lambdaGR, hyper.lambdaDC], epoch)
-            aucs.append("auc train e-{} b-{}: {}\n".format(epoch,i,auc_train))
-            batch_loss_total = batch_loss_tag # + batch_loss_dc
-            batch_loss_total.backward()
-            optimizer.step()
+            profiler.step(epoch, i)
+            # the gradients of accum_steps batches are summed before each optimizer step (the last one of the epoch may sum fewer);
+            # in between, the processes do not need to exchange them
+            optimizerStep = (i + 1) % accumSteps == 0 or lastBatch
+            with trainModel.no_sync() if worldSize > 1 and not optimizerStep else contextlib.nullcontext():
+                batch_loss_tag, batch_loss_dc, dc_val, outTag = processBatch(args, device, varSet, data, trainModel, criterion, [hyper.lambdaTag, hyper.lambdaReg, hyper.lambdaGR, hyper.lambdaDC], epoch, profiler)
+                batch_loss_total = batch_loss_tag # + batch_loss_dc
+                with profiler.stage("backward"):
+                    scaler.scale(batch_loss_total / accumSteps).backward()
+            if optimizerStep:
+                with profiler.stage("optimizer"):
+                    scaler.step(optimizer)
+                    scaler.update()
+                    optimizer.zero_grad()
             model.eval()
-            train_loss_tag += batch_loss_tag.item()
-            #train_loss_dc += batch_loss_dc.item()
-            #train_dc_val += dc_val.item()
-            train_loss_total += batch_loss_total.item()
+            updateMetrics(train_metrics, device, data[0], batch_loss_tag, batch_loss_dc, dc_val, batch_loss_total, outTag)
             # writer.add_scalar('training loss', train_loss_total / 1000, epoch * len(loader_train) + i)
-            del batch_loss_tag, batch_loss_total, dc_val
-        train_loss_tag /= len(loader_train)
-        train_loss_dc /= len(loader_train)
-        train_dc_val /= len(loader_train)
-        train_loss_total /= len(loader_train)
-        training_losses_tag[epoch] = train_loss_tag
-        training_losses_dc[epoch] = train_loss_dc
-        training_losses_total[epoch] = train_loss_total
-        print("t_tag: "+ str(train_loss_tag))
-        print("t_dc: "+ str(train_loss_dc))
-        print("t_dc_val: "+ str(train_dc_val))
-        print("t_total: "+ str(train_loss_total))
-
-        # validation
-        val_loss_tag = 0
-        val_loss_dc = 0
-        val_dc_val = 0
-        val_loss_total = 0
-        for i, data in enumerate(loader_val):
-            output_loss_tag, output_loss_dc, dc_val, auc_val = processBatch(args, device, varSet, data, model, criterion, [hyper.lambdaTag, hyper.lambdaReg, hyper.lambdaGR, hyper.lambdaDC], epoch)
-            aucs.append("auc val e-{} b-{}: {}\n".format(epoch,i,auc_val))
-            output_loss_total = output_loss_tag # + output_loss_dc
-            val_loss_tag += output_loss_tag.item()
-            # val_loss_dc += output_loss_dc.item()
-            # val_dc_val += dc_val.item()
-            val_loss_total += output_loss_total.item()
-            del output_loss_tag, output_loss_dc, dc_val
-        val_loss_tag /= len(loader_val)
-        val_loss_dc /= len(loader_val)
-        val_dc_val /= len(loader_val)
-        val_loss_total /= len(loader_val)
+            del batch_loss_tag, batch_loss_total, dc_val, outTag
+            profiler.end()
+        # averages over the batches of all the processes
+        syncMetrics(train_metrics)
+        train_summary = computeMetrics(train_metrics)
+        training_losses_tag[epoch] = train_summary["tag"]
+        training_losses_dc[epoch] = train_summary["dc"]
+        training_losses_total[epoch] = train_summary["total"]
+        print("t_tag: "+ str(train_summary["tag"]))
+        print("t_dc: "+ str(train_summary["dc"]))
+        print("t_dc_val: "+ str(train_summary["dc_val"]))
+        print("t_total: "+ str(train_summary["total"]))
+        print("t_auc: "+ str(train_summary["auc"]))
+
+        # validation, every training.val_every epochs and after the last one; NaN in the epochs without
+        validate = (epoch + 1) % args.training.val_every == 0 or epoch == hyper.epochs - 1
+        val_metrics = makeMetrics(device)
+        if validate:
+            # evaluated with the bare model, which does not synchronize with the other processes:
+            # their validation shards may have different numbers of batches
+            with torch.no_grad():
+                for i, data in enumerate(loader_val):
+                    profiler.step(epoch, i, "val")
+                    output_loss_tag, output_loss_dc, dc_val, outTag = processBatch(args, device, varSet, data, model, criterion, [hyper.lambdaTag, hyper.lambdaReg, hyper.lambdaGR, hyper.lambdaDC], epoch, profiler)
+                    output_loss_total = output_loss_tag # + output_loss_dc
+                    updateMetrics(val_metrics, device, data[0], output_loss_tag, output_loss_dc, dc_val, output_loss_total, outTag)
+                    del output_loss_tag, output_loss_dc, dc_val, outTag
+                    profiler.end()
+            syncMetrics(val_metrics)
+        val_summary = computeMetrics(val_metrics)
         scheduler.step()
         #scheduler.step(torch.tensor([val_loss_total]))
-        validation_losses_tag[epoch] = val_loss_tag
-        validation_losses_dc[epoch] = val_loss_dc
-        validation_losses_total[epoch] = val_loss_total
-        print("v_tag: "+ str(val_loss_tag))
-        print("v_dc: "+ str(val_loss_dc))
-        print("v_dc_val: "+ str(val_dc_val))
-        print("v_total: "+ str(val_loss_total))
+        validation_losses_tag[epoch] = val_summary["tag"]
+        validation_losses_dc[epoch] = val_summary["dc"]
+        validation_losses_total[epoch] = val_summary["total"]
+        print("v_tag: "+ str(val_summary["tag"]))
+        print("v_dc: "+ str(val_summary["dc"]))
+        print("v_dc_val: "+ str(val_summary["dc_val"]))
+        print("v_total: "+ str(val_summary["total"]))
+        print("v_auc: "+ str(val_summary["auc"]))
+        # one line per epoch instead of one per batch
+        summary = dict([("epoch", epoch)] + [("t_" + name, value) for name, value in train_summary.items()] + [("v_" + name, value) for name, value in val_summary.items()])
+        if isMain:
+            with open(args.outf + "/metrics.csv", "w" if epoch == 0 else "a") as metricsFile:
+                if epoch == 0:
+                    metricsFile.write(",".join(summary.keys()) + "\n")
+                metricsFile.write(",".join(str(value) for value in summary.values()) + "\n")
+        # early stopping; the summaries are synced, so every process takes the same decision
+        improved = False
+        if validate and args.training.early_stopping is not None:
+            value = val_summary["total"] if args.training.early_stopping == "loss" else val_summary["auc"]
+            best = earlyStopping["best"]
+            if not np.isnan(value) and (best is None or (value < best if args.training.early_stopping == "loss" else value > best)):
+                improved = True
+                earlyStopping.update(best=value, bestEpoch=epoch, badChecks=0)
+                bestState = toCPU(model.state_dict())
+            else:
+                earlyStopping["badChecks"] += 1
+            print("best v_{}: {} (epoch {})".format(args.training.early_stopping, earlyStopping["best"], earlyStopping["bestEpoch"]))
+            # stop after training.patience checks in a row without improvement
+            stopped = earlyStopping["badChecks"] >= args.training.patience
         # save the model
         model.eval()
-        torch.save(model.state_dict(), modelLocation)
+        if isMain:
+            # the bare weights (read by validation.py) and the full state to resume from, written in the background
+            states = {
+                modelLocation: model.state_dict(),
+                checkpointLocation: {"model": model.state_dict(), "optimizer": optimizer.state_dict(), "scheduler": scheduler.state_dict(), "epoch": epoch, "scaler": scaler.state_dict(), "rng": getRNGState(), "losses": losses, "early_stopping": earlyStopping},
+            }
+            if improved:
+                states[bestLocation] = bestState
+            checkpointer.save(states)
         torch.cuda.empty_cache()
+        if stopped:
+            print("Stopping early: no improvement of v_{} in {} validation checks".format(args.training.early_stopping, earlyStopping["badChecks"]))
+            break
     # writer.close()
+    profiler.close()
+    if isMain and bestState is not None:
+        # the model kept is the best one rather than the last
+        print("Keeping the model of epoch {} in {}".format(earlyStopping["bestEpoch"], modelLocation))
+        checkpointer.save({modelLocation: bestState})
+    checkpointer.wait()
 
-    # plot loss/epoch for training and validation sets
-    print("Making basic validation plots")
-    training_tag = plt.plot(training_losses_tag, label='training_tag')
-    validation_tag = plt.plot(validation_losses_tag, label='validation_tag')
-    training_dc = plt.plot(training_losses_dc, label='training_dc')
-    validation_dc = plt.plot(validation_losses_dc, label='validation_dc')
-    training_total = plt.plot(training_losses_total, label='training_total')
-    validation_total = plt.plot(validation_losses_total, label='validation_total')
-    plt.xlabel("epoch")
-    plt.ylabel("Loss")
-    plt.legend()
-    plt.savefig(args.outf + "/loss_plot.png")
-    np.savez(args.outf + "/normMeanStd",normMean=entireDataSet.normMean,normStd=entireDataSet.normstd)
-    aucFile = open(args.outf + "/auc.txt", "w+")
-    aucFile.writelines(aucs)
-    aucFile.close()
-    parser.write_config(args, args.outf + "/config_out.py")
+    if isMain:
+        # plot loss/epoch for training and validation sets
+        print("Making basic validation plots")
+        training_tag = plt.plot(training_losses_tag, label='training_tag')
+        validation_tag = plt.plot(validation_losses_tag, label='validation_tag')
+        training_dc = plt.plot(training_losses_dc, label='training_dc')
+        validation_dc = plt.plot(validation_losses_dc, label='validation_dc')
+        training_total = plt.plot(training_losses_total, label='training_total')
+        validation_total = plt.plot(validation_losses_total, label='validation_total')
+        plt.xlabel("epoch")
+        plt.ylabel("Loss")
+        plt.legend()
+        plt.savefig(args.outf + "/loss_plot.png")
+        parser.write_config(args, args.outf + "/config_out.py")
+    cleanupDistributed()
+    return dict(summary, best_epoch=earlyStopping["bestEpoch"], best_value=earlyStopping["best"])
 
 if __name__ == "__main__":
     main()
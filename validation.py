@@ -1,11 +1,10 @@
 import torch
 import torch.nn as nn
-from torch.nn import functional as f
-import torch.utils.data as udata
-from torch.cuda.amp import autocast
 import os
-import particlenet_pf
-from dataset import RootDataset, get_sizes
+from precision import checkPrecision
+from scoring import TorchScorer, ONNXScorer
+from export import buildModel
+from dataset import getRootDataset, splitIndices, getBatchLoader, getLoaderOptions, loadNormStats
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 from magiconfig import ArgumentParser, MagiConfigOptions, ArgumentDefaultsRawHelpFormatter
@@ -18,7 +17,6 @@ from scipy import stats
 from scipy.spatial.distance import pdist, squareform
 from tqdm import tqdm
 import itertools
-import copy
 
 mpl.rc("font", family="serif", size=18)
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
@@ -47,42 +45,42 @@ def collectiveKS(dataList):
         ksSum += pv
     return ksSum/len(allComs)
 
-def getNNOutput(dataset, model):
+def getNNOutput(dataset, indices, scorer, **loaderOptions):
+    # scorer: a TorchScorer or an ONNXScorer (scoring.py)
     batchSize = 512
-    labels = np.array([])
-    output_tags = np.array([])
-    mcT = np.array([])
-    pTL = np.array([])
-    pT = np.array([])
-    mT = np.array([])
-    weight = np.array([])
-    meds = np.array([])
-    darks = np.array([])
-    rinvs = np.array([])
-    alphas = np.array([])
-    loader = udata.DataLoader(dataset=dataset, batch_size=batchSize, num_workers=0)
+    # the outputs are filled batch by batch into preallocated arrays instead of being concatenated
+    numJets = len(indices)
+    labels = np.empty(numJets)
+    output_tags = np.empty(numJets)
+    mcT = np.empty(numJets)
+    pTL = np.empty(numJets)
+    pT = np.empty(numJets)
+    mT = np.empty(numJets)
+    weight = np.empty(numJets)
+    meds = np.empty(numJets)
+    darks = np.empty(numJets)
+    rinvs = np.empty(numJets)
+    alphas = np.empty(numJets)
+    loader = getBatchLoader(dataset, indices, batchSize, **loaderOptions)
+    start = 0
     for i, data in tqdm(enumerate(loader), unit="batch", total=len(loader)):
         print("\nLoading batch {}".format(i+1))
-        l, points, features, mct, pl, p, m, w, med, dark, rinv, alpha = data
-        labels = np.concatenate((labels,l.squeeze(1).numpy()))
-        mcT = np.concatenate((mcT,mct.squeeze(1).numpy()))
-        pTL = np.concatenate((pTL,pl.squeeze(1).float().numpy()))
-        pT = np.concatenate((pT,p.squeeze(1).float().numpy()))
-        mT = np.concatenate((mT,m.squeeze(1).float().numpy()))
-        weight = np.concatenate((weight,w.squeeze(1).float().numpy()))
-        meds = np.concatenate((meds,med.squeeze(1).float().numpy()))
-        darks = np.concatenate((darks,dark.squeeze(1).float().numpy()))
-        rinvs = np.concatenate((rinvs,rinv.squeeze(1).float().numpy()))
-        alphas = np.concatenate((alphas,alpha.squeeze(1).numpy()))
-        model.eval()
-        inputPoints = points.float()
-        inputFeatures = features.float()
-        print("size of inputPoints: {}".format(inputPoints.size()))
-        print("size of inputFeatures: {}".format(inputFeatures.size()))
-        with autocast():
-            out_tag = model(inputPoints,inputFeatures)
-            output_tag = f.softmax(out_tag,dim=1)[:,1].detach().numpy()
-            output_tags = np.concatenate((output_tags,output_tag))
+        l, points, features, mct, pl, p, m, w, med, dark, rinv, alpha, knnIdx = data
+        batch = slice(start, start + len(l))
+        start += len(l)
+        labels[batch] = l.squeeze(1).numpy()
+        mcT[batch] = mct.squeeze(1).numpy()
+        pTL[batch] = pl.squeeze(1).numpy()
+        pT[batch] = p.squeeze(1).numpy()
+        mT[batch] = m.squeeze(1).numpy()
+        weight[batch] = w.squeeze(1).numpy()
+        meds[batch] = med.squeeze(1).numpy()
+        darks[batch] = dark.squeeze(1).numpy()
+        rinvs[batch] = rinv.squeeze(1).numpy()
+        alphas[batch] = alpha.squeeze(1).numpy()
+        print("size of inputPoints: {}".format(points.size()))
+        print("size of inputFeatures: {}".format(features.size()))
+        output_tags[batch] = scorer(points, features, knnIdx)
     return labels, output_tags, mcT, pTL, pT, mT, weight, meds, darks, rinvs, alphas
 
 def getROCStuff(label, output, weights=None):
@@ -281,6 +279,7 @@ def main():
     parser.add_argument("--outf", type=str, default="logs", help='Name of folder to be used to store outputs')
     parser.add_argument("--model", type=str, default="net.pth", help="Existing model to continue training, if applicable")
     parser.add_argument("--pIn", action="store_true", help="Plot input variables and their correlation.")
+    parser.add_argument("--onnx", type=str, default=None, help="Score with this ONNX model in the output folder (export.py --format onnx) through ONNX Runtime instead of PyTorch")
     parser.add_config_only(*c.config_schema)
     parser.add_config_only(**c.config_defaults)
     args = parser.parse_args()
@@ -289,6 +288,7 @@ def main():
     # Choose cpu or gpu
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     print('Using device:', device)
+    checkPrecision(args.training.precision, device)
     if device.type == 'cuda':
         gpuIndex = torch.cuda.current_device()
         print("Using GPU named: \"{}\"".format(torch.cuda.get_device_name(gpuIndex)))
@@ -297,31 +297,32 @@ def main():
     # Load dataset
     print('Loading dataset...')
     dSet = args.dataset
-    sigFiles = dSet.signal
-    inputFiles = dSet.background
-    hyper = args.hyper
-    inputFiles.update(sigFiles)
     varSet = args.features.train
     inputFeatureVars = [var for var in varSet if var not in ["jCsthvCategory","jCstEvtNum","jCstJNum"]]
     print("Input feature variables:",inputFeatureVars)
-    pTBins = hyper.pTBins
-    uniform = args.features.uniform
-    mT = args.features.mT
-    weight = args.features.weight
-    dataset = RootDataset(inputFolder=dSet.path, root_file=inputFiles, variables=varSet, pTBins=pTBins, uniform=uniform, mT=mT, weight=weight)
-    sizes = get_sizes(len(dataset), dSet.sample_fractions)
-    train, val, test = udata.random_split(dataset, sizes, generator=torch.Generator().manual_seed(42))
+    # normalize the inputs with the statistics of the training sample, if they were saved with the model
+    normStats = None
+    normStatsFile = "{}/normMeanStd.npz".format(args.outf)
+    if os.path.isfile(normStatsFile):
+        print("Using normalization from " + normStatsFile)
+        normStats = loadNormStats(normStatsFile)
+    # the ONNX model computes the neighbours itself
+    dataset = getRootDataset(args, normStats, precomputeKnn=args.onnx is None)
+    trainIndices, valIndices, testIndices = splitIndices(np.arange(len(dataset)), dSet.sample_fractions)
+    loaderOptions = getLoaderOptions(args.training.num_workers, args.training.persistent_workers, args.training.prefetch_factor, args.training.pin_memory)
     # Build model
-    network_module = particlenet_pf
-    network_options = {}
-    model = network_module.get_model(inputFeatureVars,**network_options)
-    model = copy.deepcopy(model)
-    print("Loading model from file " + modelLocation)
-    model.load_state_dict(torch.load(modelLocation))
-    model.eval()
-    model.to(device)
-    label_train, output_train_tag, mcT_train, pTLab_train, pT_train, mT_train, w_train, med_train, dark_train, rinv_train, alpha_train = getNNOutput(train, model)
-    label_test, output_test_tag, mcT_test, pTLab_test, pT_test, mT_test, w_test, med_test, dark_test, rinv_test, alpha_test = getNNOutput(test, model)
+    if args.onnx is not None:
+        onnxLocation = "{}/{}".format(args.outf,args.onnx)
+        print("Scoring with ONNX Runtime model " + onnxLocation)
+        scorer = ONNXScorer(onnxLocation)
+    else:
+        # the architecture the model was trained with
+        print("Loading model from file " + modelLocation)
+        model = buildModel(args, modelLocation, forInference=False)
+        model.to(device)
+        scorer = TorchScorer(model, device, args.training.precision)
+    label_train, output_train_tag, mcT_train, pTLab_train, pT_train, mT_train, w_train, med_train, dark_train, rinv_train, alpha_train = getNNOutput(dataset, trainIndices, scorer, **loaderOptions)
+    label_test, output_test_tag, mcT_test, pTLab_test, pT_test, mT_test, w_test, med_test, dark_test, rinv_test, alpha_test = getNNOutput(dataset, testIndices, scorer, **loaderOptions)
     fpr_Train, tpr_Train, auc_Train = getROCStuff(label_train, output_train_tag, w_train)
     fpr_Test, tpr_Test, auc_Test = getROCStuff(label_test, output_test_tag, w_test)
     baseline_train = mcT_train == 1